@@ -2,6 +2,12 @@
 import re
 import os
 import sys
+import json
+import time
+import hashlib
+import bisect
+import functools
+import itertools
 
 import tags as tagger
 import common
@@ -14,6 +20,11 @@ class CheckerBase:
     """
     def __init__(self):
         self.errors = 0
+        # If a list, print_error() appends (file_dict_path_str, severity,
+        # error, text) records to it instead of displaying errors.
+        self.error_sink = None
+        # where display_error() writes errors, see DiagnosticsOutput
+        self.output = HumanOutput()
 
     colors = {"normal": ""}
     if os.isatty(sys.stdout.fileno()):
@@ -67,12 +78,13 @@ class CheckerBase:
         return "\n".join(to_print)
 
     def print_error(self, file_dict_path_str, severity, error, text):
-        # sadly, we can't give line numbers...
-        print("%s: %s%s" % (self.severities_text.get(severity, severity),
-                            error, self.colors['normal']))
-        print("at %s" % (self.wrap_output(file_dict_path_str, 80-3, "\t\t")))
-        print("   %s%s" % (self.wrap_output(text, 72, '\t', '   '),
-                           self.colors["normal"]))
+        if self.error_sink is not None:
+            self.error_sink.append((file_dict_path_str, severity, error, text))
+            return
+        self.display_error(file_dict_path_str, severity, error, text)
+
+    def display_error(self, file_dict_path_str, severity, error, text):
+        self.output.add(file_dict_path_str, severity, error, text)
         if severity == "error":
             self.errors += 1
 
@@ -84,30 +96,204 @@ class CheckerBase:
         return print_please
 
 
-def iterate_escapes(string):
-    r"""Iterate escapes of the form \X
+class DiagnosticsOutput:
+    """Base class of the outputs of checkers.
+
+    Diagnostics are formatted by subclasses into a buffer, which is written
+    to stream in big chunks.  If stream is None, write to sys.stdout at
+    that time.  Also count diagnostics by severity and by rule, see
+    get_rule()."""
+    buffer_size = 65536
+    # parameters of errors: names of variables, which may be anything,
+    # parenthesized or quoted text and sizes.
+    rule_parameter_regexes = [re.compile(regex, re.S) for regex in (
+        r"(?<=^unknown variable ).*(?= not in original$)",
+        r"(?<=^variable reference ).*?(?= is known)",
+        r"\(.*\)",
+        r"""'[^']*'|"[^"]*"|\d+(?=px)""")]
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.buffer = []
+        self.buffered = 0
+        self.severities = {}
+        self.rules = {}
 
-    yield (index_from, index_of_escape), where index_from is where the search
-    started from, and index_of_escape is the next escape.  Thus
-    string[index_from:index_of_escape] will not contain escapes.
+    @classmethod
+    def get_rule(cls, error):
+        """Return what kind of error this is, by removing its parameters.
+
+        Names of badnesses are kept, since they are rules by themselves."""
+        if error.startswith("badness '"):
+            return error
+        for regex in cls.rule_parameter_regexes:
+            error = regex.sub("…", error)
+        return error
+
+    def write(self, string):
+        self.buffer.append(string)
+        self.buffered += len(string)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write("".join(self.buffer))
+        stream.flush()
+        self.buffer = []
+        self.buffered = 0
+
+    def add(self, file_dict_path_str, severity, error, text):
+        """Add a diagnostic"""
+        rule = self.get_rule(error)
+        self.severities[severity] = self.severities.get(severity, 0) + 1
+        self.rules[rule] = self.rules.get(rule, 0) + 1
+        self.format(file_dict_path_str, severity, rule, error, text)
+
+    def format(self, file_dict_path_str, severity, rule, error, text):
+        raise NotImplementedError()
+
+    def finish(self):
+        """Write the summary of diagnostics, flush and start counting again"""
+        self.format_summary()
+        self.flush()
+        self.severities = {}
+        self.rules = {}
+
+    def format_summary(self):
+        raise NotImplementedError()
+
+
+class HumanOutput(DiagnosticsOutput):
+    """Output for humans, with colors if stdout is a terminal"""
+    def format(self, file_dict_path_str, severity, rule, error, text):
+        colors = CheckerBase.colors
+        # sadly, we can't give line numbers...
+        self.write("%s: %s%s\n" % (
+            CheckerBase.severities_text.get(severity, severity), error,
+            colors['normal']))
+        self.write("at %s\n" % (
+            CheckerBase.wrap_output(file_dict_path_str, 80-3, "\t\t")))
+        self.write("   %s%s\n" % (
+            CheckerBase.wrap_output(text, 72, '\t', '   '),
+            colors["normal"]))
+
+    def format_summary(self):
+        if not self.severities:
+            return
+        self.write("Summary: %s\n" % ", ".join(
+            "%s: %d" % (severity, count) for severity, count
+            in sorted(self.severities.items())))
+        for rule, count in sorted(self.rules.items(),
+                                  key=lambda item: item[1], reverse=True):
+            self.write("%8d %s\n" % (count, rule))
+
+
+class MachineOutput(DiagnosticsOutput):
+    """Base class of outputs meant for programs, without colors."""
+    ansi_regex = re.compile("\033\\[[0-9;]*m")
+
+    def make_record(self, file_dict_path_str, severity, rule, error, text):
+        return {"path": file_dict_path_str, "severity": severity,
+                "rule": rule, "message": self.ansi_regex.sub("", error),
+                "text": self.ansi_regex.sub("", text)}
+
+    def make_summary(self):
+        return {"severities": self.severities, "rules": self.rules}
+
+
+class JsonLinesOutput(MachineOutput):
+    """One json object per line and per diagnostic.
+
+    The last line is {"summary": {"severities": {...}, "rules": {...}}},
+    with the number of diagnostics of each severity and rule."""
+    def format(self, file_dict_path_str, severity, rule, error, text):
+        record = self.make_record(file_dict_path_str, severity, rule,
+                                  error, text)
+        self.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def format_summary(self):
+        self.write(json.dumps({"summary": self.make_summary()},
+                              ensure_ascii=False) + "\n")
+
+
+class SarifOutput(MachineOutput):
+    """A SARIF-like json document, written at the end.
+
+    Paths are given as logical locations, and the summary is in the
+    properties of the run."""
+    levels = {"error": "error", "warn": "warning"}
+
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        self.results = []
+
+    def format(self, file_dict_path_str, severity, rule, error, text):
+        record = self.make_record(file_dict_path_str, severity, rule,
+                                  error, text)
+        self.results.append({
+            "ruleId": rule,
+            "level": self.levels.get(severity, "note"),
+            "message": {"text": record["message"]},
+            "locations": [{"logicalLocations": [
+                {"fullyQualifiedName": file_dict_path_str}]}],
+            "properties": {"severity": severity, "text": record["text"]}
+        })
+
+    def format_summary(self):
+        run = {
+            "tool": {"driver": {"name": "jsontr.py check", "rules": [
+                {"id": rule} for rule in sorted(self.rules)]}},
+            "results": self.results,
+            "properties": self.make_summary()
+        }
+        self.write(json.dumps({"version": "2.1.0", "runs": [run]},
+                              indent=1, ensure_ascii=False) + "\n")
+        self.results = []
 
-    if a index is sent to this method, then the next iteration will start
-    searching at this position (it will become index_from), instead of
-    the last index_of_escape + 2
-    """
-    last = 0
-    index = string.find('\\')
-    while 0 <= index < len(string):
-        next_index = yield (last, index)
-        if next_index is not None:
-            index = next_index
-            yield None
-        else:
-            # skip \ and the next char
-            index = index + 2
-        last = index
-        index = string.find('\\', index)
-    yield (last, len(string))
+
+class CollectingOutput(DiagnosticsOutput):
+    """Keep diagnostics by file_dict_path_str, in errors_by_path.
+
+    Diagnostics are also added to the forward_to output, if not None."""
+    def __init__(self, forward_to=None):
+        super().__init__()
+        self.forward_to = forward_to
+        # file_dict_path_str -> [(severity, error, text)]
+        self.errors_by_path = {}
+
+    def add(self, file_dict_path_str, severity, error, text):
+        super().add(file_dict_path_str, severity, error, text)
+        if self.forward_to is not None:
+            self.forward_to.add(file_dict_path_str, severity, error, text)
+
+    def format(self, file_dict_path_str, severity, rule, error, text):
+        errors = self.errors_by_path.setdefault(file_dict_path_str, [])
+        errors.append((severity, error, text))
+
+    def finish(self):
+        super().finish()
+        if self.forward_to is not None:
+            self.forward_to.finish()
+
+    def format_summary(self):
+        pass
+
+
+# name of --output-format -> DiagnosticsOutput class
+output_formats = {"human": HumanOutput, "jsonl": JsonLinesOutput,
+                  "sarif": SarifOutput}
+
+
+class OrigProfile:
+    """What the checks of a translation need to know about its original text
+
+    Icons and variable references are sets of the parameters of these
+    commands."""
+    def __init__(self, text):
+        self.text = text
+        self.icons = set()
+        self.varrefs = set()
 
 
 class CheckerLexer(CheckerBase):
@@ -123,6 +309,14 @@ class CheckerLexer(CheckerBase):
     VARREF = "VARREF"
     ICON = "ICON"
 
+    # not a token type: lex_events() uses it for (WARNING, (severity, error))
+    WARNING = "WARNING"
+
+    # (text) | (command with parameter) | (any other escape, or a backslash
+    # at the end of the text)
+    lexer_regex = re.compile(r"([^\\]+)|\\([csiv])\[([^\]]*)\]|\\(.?)", re.S)
+    command_types = {'c': COLOR, 's': SPEED, 'i': ICON, 'v': VARREF}
+
     @classmethod
     def lex_that_text(cls, text, warn_func):
         """Lex the text
@@ -136,33 +330,44 @@ class CheckerLexer(CheckerBase):
         for ESCAPE, text is always '\\'.
         for COLOR, ICON, SPEED, VARREF, text is the parameter of the command.
         """
-        iterator = iterate_escapes(text)
-        for last_index, index in iterator:
-            part = text[last_index:index]
-            if part:
-                yield cls.TEXT, part
-            char = text[index+1: index+2]
-
-            if char in '.!':
-                # delaying commands
-                yield cls.DELAY, char
+        for type_, value in cls.lex_events(text):
+            if type_ is cls.WARNING:
+                warn_func(*value)
+            else:
+                yield type_, value
+
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def lex_events(cls, text):
+        """Lex the text, returning a tuple of tokens and warnings.
+
+        Tokens are returned as lex_that_text() yields them, and warnings
+        as (WARNING, (severity, error)), in order of appearance.  Results are
+        cached, since the same texts are lexed many times."""
+        events = []
+        for match in cls.lexer_regex.finditer(text):
+            part, command, parameter, char = match.groups()
+            if part is not None:
+                events.append((cls.TEXT, part))
+            elif command is not None:
+                events.append((cls.command_types[command], parameter))
+            elif char in '.!':
+                # delaying commands, or a '\' at the end of the text.
+                events.append((cls.DELAY, char))
             elif char == '\\':
-                yield cls.ESCAPE, char
+                events.append((cls.ESCAPE, char))
             elif char in 'csiv':
-                if text[index+2:index+3] != '[':
-                    warn_func("error", "'\\%s' not followed by '['" % char)
-                    continue
-                end = text.find(']', index+2)
-                if end == -1:
-                    warn_func("error", "'\\%s[' not finished" % char)
-                    continue
-                inner = text[index+3:end]
-                type_ = {'c': cls.COLOR, 's': cls.SPEED,
-                         'i': cls.ICON, 'v': cls.VARREF}[char]
-                yield type_, inner
-                iterator.send(end+1)
+                if text[match.end():match.end()+1] != '[':
+                    error = "'\\%s' not followed by '['" % char
+                else:
+                    error = "'\\%s[' not finished" % char
+                events.append((cls.WARNING, ("error", error)))
             else:
-                warn_func("warn", "unknown escape '\\%s'" % char)
+                events.append((cls.WARNING,
+                               ("warn", "unknown escape '\\%s'" % char)))
+        # historically, every text ended with an empty delay
+        events.append((cls.DELAY, ''))
+        return tuple(events)
 
     @staticmethod
     def check_number(text, warn_func):
@@ -171,13 +376,17 @@ class CheckerLexer(CheckerBase):
             warn_func("error", "'%s' is not a number" % text)
         return text
 
-    def find_stuff_in_orig(self, text, wanted_type):
-        """find token of the given type in the text, without warning
-
-        yield all values of the give token type"""
-        for type_, value in self.lex_that_text(text, lambda a, b: None):
-            if type_ is wanted_type:
-                yield value
+    def profile_orig(self, orig):
+        """Lex the original text once, without warning, see OrigProfile"""
+        profile = OrigProfile(orig)
+        if orig is None:
+            return profile
+        for type_, value in self.lex_that_text(orig, lambda a, b: None):
+            if type_ is self.ICON:
+                profile.icons.add(value)
+            elif type_ is self.VARREF:
+                profile.varrefs.add(value)
+        return profile
 
     VARIABLES = [
         (["lore", "title", "#1"], ["database.json"], ['lore', "#1", 'title']),
@@ -280,22 +489,21 @@ class CheckerLexer(CheckerBase):
 
         return all(word in haystack for word in needle.split())
 
-    def lookup_var_checked(self, name, warn_func, orig, get_text):
+    def lookup_var_checked(self, name, warn_func, orig_profile, get_text):
         """Look up the given variable and return a replacement
 
         This performs many checks along the way.  The replacement is allowed to
         be very different from the actual text.
 
+        orig_profile is the OrigProfile of the original text.
         get_text(file_path, dict_path, warn_func) should look up the
         translation for the given reference.  It is used to replace variable
         references to known texts.
         """
+        orig = orig_profile.text
 
         def exists_in_orig():
-            for maybevar in self.find_stuff_in_orig(orig, self.VARREF):
-                if maybevar == name:
-                    return True
-            return False
+            return name in orig_profile.varrefs
 
         result = self.lookup_var_ref(name, warn_func)
         if isinstance(result, str):
@@ -335,6 +543,7 @@ class CheckerLexer(CheckerBase):
         current_color = "0"
         # default speed depends on the context
         current_speed = "-1"
+        orig_profile = self.profile_orig(orig)
 
         for type_, value in self.lex_that_text(text, warn_func):
             if type_ is self.TEXT:
@@ -364,12 +573,12 @@ class CheckerLexer(CheckerBase):
                     warn_func("warn", "same speed specified twice")
                 current_speed = value
             elif type_ is self.ICON:
-                if value not in self.find_stuff_in_orig(orig, self.ICON):
+                if value not in orig_profile.icons:
                     warn_func("notice", "icon not present in original text")
                 yield RenderedText.icon(value)
             elif type_ is self.VARREF:
-                value = self.lookup_var_checked(value, warn_func, orig,
-                                                get_text)
+                value = self.lookup_var_checked(value, warn_func,
+                                                orig_profile, get_text)
                 yield RenderedText.text(value)
             else:
                 assert False
@@ -384,50 +593,66 @@ class RenderedText:
     it may also contain stuff like the next space following the text
     or the size of the text in pseudo-pixels.  It may also contains minimal
     information about icons"""
+    __slots__ = ("plain_parts", "ansi_parts", "length", "size", "space",
+                 "icons", "icon_positions")
+
     def __init__(self, plain="", ansi="", size=0, space=None, icons=()):
-        # raw text without any ansi escape or var references.
-        self.plain = plain
-        # rendered text with ansi escapes and possible icons placeholders
-        self.ansi = ansi
+        # raw text without any ansi escape or var references, as fragments
+        # joined when needed.  See the plain property.
+        self.plain_parts = [plain] if plain else []
+        # rendered text with ansi escapes and possible icons placeholders,
+        # as fragments.  See the ansi property.
+        self.ansi_parts = [ansi] if ansi else []
+        # length of plain
+        self.length = len(plain)
         # horizontal size once rendered
         self.size = size
         # the space character that follows this text, or None for no space.
         self.space = space
         # contains a list of used icons
         self.icons = list(icons)
+        # for each icon, the index in plain where it is rendered
+        self.icon_positions = [0] * len(self.icons)
+
+    @staticmethod
+    def join_parts(parts):
+        if len(parts) != 1:
+            parts[:] = ["".join(parts)]
+        return parts[0]
+
+    @property
+    def plain(self):
+        return self.join_parts(self.plain_parts)
+
+    @property
+    def ansi(self):
+        return self.join_parts(self.ansi_parts)
 
     def add_plain_text(self, text):
         """add plain text, to both ansi and plain"""
-        self.plain += text
-        self.ansi += text
+        if text:
+            self.plain_parts.append(text)
+            self.ansi_parts.append(text)
+            self.length += len(text)
 
     def append_rendered(self, rendered_text, space_size = 0):
         """Append a rendered text to this rendered text.
 
         If our space character is ' ', then space_size is added to the size"""
         space = self.space if self.space is not None else ""
-        self.plain += space + rendered_text.plain
-        self.ansi += space + rendered_text.ansi
+        offset = self.length + len(space)
+        self.icon_positions.extend(offset + position for position
+                                   in rendered_text.icon_positions)
+        if space:
+            self.plain_parts.append(space)
+            self.ansi_parts.append(space)
+        self.plain_parts.extend(rendered_text.plain_parts)
+        self.ansi_parts.extend(rendered_text.ansi_parts)
+        self.length = offset + rendered_text.length
         self.size += rendered_text.size + (space_size if space == ' ' else 0)
         self.space = rendered_text.space
         self.icons.extend(rendered_text.icons)
 
-    def chomp_last_char(self):
-        """Remove the last character from the RenderedText and return it
-
-        This may also chomp icons.
-        Chomping an empty RenderedText will raise IndexError"""
-        while self.ansi[-1] != self.plain[-1]:
-            if self.ansi.endswith(self.ICON_PLACEHOLDER):
-                self.icons.pop()
-                self.ansi = self.ansi[:-len(self.ICON_PLACEHOLDER)]
-                return self.ICON_PLACEHOLDER
-            self.ansi = self.ansi[:-1]
-        self.ansi = self.ansi[:-1]
-        ret = self.plain[-1]
-        self.plain = self.plain[:-1]
-        return ret
-
     @classmethod
     def text(cls, text):
         return cls(text, text)
@@ -447,16 +672,7 @@ class RenderedText:
 
 class Formatter:
     """Format the given text, split it in words, do line wrapping..."""
-    @staticmethod
-    def get_next_space_index(string):
-        """Find the index of the next ' ' or '\n' character."""
-        next_space = string.find(' ')
-        next_nl = string.find('\n')
-        if next_space == -1:
-            return next_nl
-        if next_nl == -1:
-            return next_space
-        return min(next_space, next_nl)
+    space_regex = re.compile('[ \n]')
 
     @classmethod
     def get_words(cls, iterable):
@@ -474,23 +690,20 @@ class Formatter:
         current_word = RenderedText() # invariant: current_word.space is None
         for basic_rendered_text in iterable:
 
-            if not basic_rendered_text.plain:
+            if not basic_rendered_text.length:
                 # icon or color
                 current_word.append_rendered(basic_rendered_text)
                 continue
             # everything else is pure text
             plaintext = basic_rendered_text.plain
-            while plaintext:
-                next_space = cls.get_next_space_index(plaintext)
-
-                if next_space == -1:
-                    next_space = len(plaintext)
-                current_word.add_plain_text(plaintext[:next_space])
-                if next_space != len(plaintext):
-                    current_word.space = plaintext[next_space]
-                    words.append(current_word)
-                    current_word = RenderedText()
-                plaintext = plaintext[next_space+1:]
+            start = 0
+            for match in cls.space_regex.finditer(plaintext):
+                current_word.add_plain_text(plaintext[start:match.start()])
+                current_word.space = match.group()
+                words.append(current_word)
+                current_word = RenderedText()
+                start = match.end()
+            current_word.add_plain_text(plaintext[start:])
         words.append(current_word)
         return words
 
@@ -524,26 +737,200 @@ class Formatter:
         return lines
 
 
+class FontMetrics:
+    """Widths of the characters and icons of a font type
+
+    Characters of the Basic Multilingual Plane are looked up in a table
+    indexed by code point, other characters and icons in a dict."""
+    table_size = 0x10000
+
+    def __init__(self, values):
+        """values is a font type of the "metrics" check setting"""
+        self.table = [None] * self.table_size
+        self.others = {}
+        for i, size in enumerate(values.get("metrics", ())):
+            if size > 0:
+                self.table[i+32] = size
+        for key, size in values.get("extra_metrics", {}).items():
+            if len(key) == 1 and ord(key) < self.table_size:
+                self.table[ord(key)] = size
+            else:
+                self.others[key] = size
+        # the same words are measured over and over
+        self.measure = functools.lru_cache(maxsize=16384)(self.measure_text)
+
+    def get(self, key, default=None):
+        """Return the width of a character or icon, like dict.get()"""
+        if len(key) == 1 and ord(key) < self.table_size:
+            size = self.table[ord(key)]
+            return default if size is None else size
+        return self.others.get(key, default)
+
+    def measure_text(self, text):
+        """Return the width of a text and its characters without metrics.
+
+        Characters without metrics count as 1 pseudo-pixel.  Use measure(),
+        which caches results, instead."""
+        try:
+            # Common case: everything is in the table.
+            return sum(map(self.table.__getitem__, map(ord, text))), ()
+        except (TypeError, IndexError):
+            pass
+        width = 0
+        missing = []
+        for char in text:
+            size = self.get(char)
+            if size is None:
+                missing.append(char)
+                size = 1
+            width += size
+        return width, tuple(missing)
+
+
+class RegexRules:
+    """Named regex rules, also combined into a single regex.
+
+    The combined regex matches if and only if one of the rules it combines
+    matches, so that texts matched by no rule are found with a single scan.
+    Rules that could behave differently once combined (backreferences,
+    named groups or global flags) are left out of it.
+
+    If timed is true, count hits and time of each rule, see get_stats()."""
+    # rough detection of references to groups, or named groups.
+    group_reference_regex = re.compile(r"\\[1-9]|\(\?P[=<]|\(\?\(")
+
+    def __init__(self, kind):
+        # what the rules are, as shown by get_stats()
+        self.kind = kind
+        # list of (name, compiled regex, data, combinable)
+        self.rules = []
+        # built by prepare() once rules are added
+        self.prepared = False
+        self.combined = None
+        # if every rule is in the combined regex
+        self.all_combined = True
+        self.timed = False
+        # rule name -> [hits, seconds], None is for the combined regex.
+        self.stats = {}
+
+    def add_rule(self, name, regex, data=None):
+        """Add a rule, regex must be compiled.  data is for subclasses"""
+        combinable = (not regex.flags & ~re.UNICODE
+                      and not self.group_reference_regex.search(
+                          regex.pattern))
+        self.rules.append((name, regex, data, combinable))
+        self.prepared = False
+
+    def prepare(self):
+        """Build the combined regex, if rules were added since last time"""
+        if self.prepared:
+            return
+        self.prepared = True
+        self.combined = None
+        patterns = ["(?:%s)" % regex.pattern
+                    for name, regex, data, combinable in self.rules
+                    if combinable]
+        self.all_combined = len(patterns) == len(self.rules)
+        if patterns:
+            try:
+                self.combined = re.compile("|".join(patterns))
+            except re.error:
+                self.all_combined = False
+
+    def count(self, name, hit, start_time):
+        """Account for a use of a rule that started at start_time
+
+        start_time is None if rules are not timed."""
+        if start_time is None:
+            return
+        stats = self.stats.setdefault(name, [0, 0.])
+        if hit:
+            stats[0] += 1
+        stats[1] += time.perf_counter() - start_time
+
+    def search_combined(self, text):
+        """Search text with the combined regex.
+
+        Return None if no combinable rule matches text, otherwise return
+        the position of the first match.  No combinable rule matches before
+        this position."""
+        if self.combined is None:
+            return None
+        start_time = time.perf_counter() if self.timed else None
+        match = self.combined.search(text)
+        self.count(None, match, start_time)
+        if match is None:
+            return None
+        return match.start()
+
+    def get_stats(self):
+        """Return a list of (kind, rule name, hits, seconds)
+
+        The rule name None stands for the combined regex."""
+        return [(self.kind, name, hits, seconds)
+                for name, (hits, seconds) in self.stats.items()]
+
+
+class BadnessRules(RegexRules):
+    """Rules flagging texts whose regex matches them"""
+    def __init__(self):
+        super().__init__("badness")
+
+    def find_matching(self, text):
+        """Return the names of rules matching text, in order"""
+        self.prepare()
+        found = None
+        if self.combined is not None:
+            found = self.search_combined(text)
+            if found is None and self.all_combined:
+                return []
+        result = []
+        for name, regex, data, combinable in self.rules:
+            start = 0
+            if combinable and self.combined is not None:
+                if found is None:
+                    continue
+                start = found
+            start_time = time.perf_counter() if self.timed else None
+            hit = regex.search(text, start) is not None
+            self.count(name, hit, start_time)
+            if hit:
+                result.append(name)
+        return result
+
+
+class ReplacementRules(RegexRules):
+    """Substitutions applied one after the other
+
+    The data of each rule is the replacement given to regex.sub()"""
+    def __init__(self):
+        super().__init__("replacement")
+
+    def apply(self, text):
+        """Apply every substitution to text and return the result"""
+        self.prepare()
+        # the result of a substitution may match an uncombinable rule.
+        if self.all_combined and self.search_combined(text) is None:
+            return text
+        for name, regex, replacement, combinable in self.rules:
+            start_time = time.perf_counter() if self.timed else None
+            text, count = regex.subn(replacement, text)
+            self.count(name, count, start_time)
+        return text
+
+
 class Checker(CheckerLexer):
     def __init__(self, check_settings):
         super().__init__()
         self.parse_options(check_settings)
+        # statistics of rules run in other processes, see get_rule_stats()
+        self.other_rule_stats = []
 
     def parse_options(self, settings):
         self.char_metrics = {}
         for fonttype, values in settings.get("metrics", {}).items():
-            metrics = {}
-            self.char_metrics[fonttype] = metrics
-            for i, size in enumerate(values.get("metrics", ())):
-                if size > 0:
-                    metrics[chr(i+32)] = size
-
-            metrics.update(values.get("extra_metrics", {}))
-        self.replacements = []
-
-        def make_repl(regex, repl):
-            return lambda s: regex.sub(repl, s)
-
+            self.char_metrics[fonttype] = FontMetrics(values)
+        self.replacements = ReplacementRules()
         for subst_regex in settings.get("replacements", ()):
             if len(subst_regex) < len('s///'):
                 raise ValueError(
@@ -553,44 +940,71 @@ class Checker(CheckerLexer):
                 raise ValueError(
                     "substitution '%s' has invalid syntax" % (subst_regex))
             try:
-                replace_func = make_repl(re.compile(splitted[1]), splitted[2])
-                replace_func("this is a test of your regex: œ")
+                regex = re.compile(splitted[1])
+                regex.sub(splitted[2], "this is a test of your regex: œ")
             except re.error:
                 raise ValueError(
                     "regex substitution '%s' failed" % subst_regex)
             else:
-                self.replacements.append(replace_func)
-
-        self.to_flag = []
-
-        def make_matcher(regex):
-            return lambda s: regex.search(s) is not None
+                self.replacements.add_rule(subst_regex, regex, splitted[2])
 
+        self.to_flag = BadnessRules()
         for name, to_flag in settings.get("badnesses", {}).items():
             try:
                 regex = re.compile(to_flag)
             except re.error:
                 raise ValueError("badness regex '%s' failed" % to_flag)
-            self.to_flag.append((name, make_matcher(regex)))
+            self.to_flag.add_rule(name, regex)
+
+    def set_rule_timing(self, timed):
+        """Enable or disable timing of badnesses and replacements"""
+        self.to_flag.timed = timed
+        self.replacements.timed = timed
+
+    def get_rule_stats(self, reset=False):
+        """Return statistics of rules, see RegexRules.get_stats()
+
+        If reset is true, start counting again from zero."""
+        stats = (self.to_flag.get_stats() + self.replacements.get_stats()
+                 + self.other_rule_stats)
+        if reset:
+            self.to_flag.stats = {}
+            self.replacements.stats = {}
+            self.other_rule_stats = []
+        return stats
+
+    @staticmethod
+    def print_rule_stats(stats):
+        """Print statistics from get_rule_stats(), slowest rules first."""
+        total = {}
+        for kind, name, hits, seconds in stats:
+            key = (kind, name)
+            previous_hits, previous_seconds = total.get(key, (0, 0.))
+            total[key] = (previous_hits + hits, previous_seconds + seconds)
+        print("%8s %10s  rule" % ("hits", "time (ms)"))
+        for (kind, name), (hits, seconds) in sorted(
+                total.items(), key=lambda item: item[1][1], reverse=True):
+            if name is None:
+                name = "(%s rules combined)" % kind
+            else:
+                name = "%s %s" % (kind, name)
+            print("%8d %10.1f  %s" % (hits, seconds * 1000, name))
 
     def calc_renderedtext_size(self, rendered_text, metrics, warn_func):
         """Calculate the size of a rendered text
 
         The resulting size may be stored in its 'size' attribute, or may used
         for other purposes."""
-        ret = 0
-
-        def iterate_stuff(iterable, warn_msg):
-            nonlocal ret
-            for item in iterable:
-                size = metrics.get(item)
-                if size is None:
-                    warn_func("warn", warn_msg % repr(item))
-                    size = 1
-                ret += size
-
-        iterate_stuff(rendered_text.plain, "Character %s has no metrics")
-        iterate_stuff(rendered_text.icons, "Icon %s has no metrics")
+        ret, missing = metrics.measure(rendered_text.plain)
+        for char in missing:
+            warn_func("warn", "Character %s has no metrics" % repr(char))
+
+        for icon in rendered_text.icons:
+            size = metrics.get(icon)
+            if size is None:
+                warn_func("warn", "Icon %s has no metrics" % repr(icon))
+                size = 1
+            ret += size
         return ret
 
     def wrap_text(self, words, metrics, boxtype):
@@ -614,34 +1028,65 @@ class Checker(CheckerLexer):
         if maxsize > boxtype[2]:
             assert boxtype[2]
             # Figure out where the cut is
-            bigline = lines[maxindex]
-            overful = ""
-            while bigline.plain:
-                overful = bigline.chomp_last_char() + overful
-                size = self.calc_renderedtext_size(bigline, metrics,
-                                                   lambda *l: None)
-                if size < boxtype[2]:
-                    break
-
+            fitting, overful = self.split_overflow(lines[maxindex], metrics,
+                                                   boxtype[2])
             warn_func("error",
                       "Overfull %s: %dpx too large" % (boxtype[1],
                                                        maxsize - boxtype[2]),
-                      '%s[]%s' % (bigline.plain, overful))
+                      '%s[]%s' % (fitting, overful))
+
+    @staticmethod
+    def split_overflow(line, metrics, width_limit):
+        """Find where a RenderedText line becomes larger than width_limit
+
+        Return (fitting, overflowing): fitting is the plain text before the
+        cut, while overflowing is what follows, with icons replaced by
+        RenderedText.ICON_PLACEHOLDER.  At least the last character or icon
+        overflows, and at least the first character fits."""
+        if not line.length:
+            return "", ""
+        characters = list(line.plain)
+        widths = [metrics.get(char, 1) for char in characters]
+        # insert icons at their place, from the last, so that positions of
+        # other icons stay valid.
+        for position, icon in reversed(list(zip(line.icon_positions,
+                                                line.icons))):
+            characters.insert(position, RenderedText.ICON_PLACEHOLDER)
+            widths.insert(position, metrics.get(icon, 1))
+        # where each icon ended up in characters
+        icon_indexes = [position + index for index, position
+                        in enumerate(line.icon_positions)]
+
+        # prefix[cut] is the width of characters[:cut]
+        prefix = [0]
+        prefix.extend(itertools.accumulate(widths))
+        # last cut where the fitting part is smaller than width_limit
+        cut = bisect.bisect_left(prefix, width_limit) - 1
+        cut = min(cut, len(characters) - 1)
+        # keep the first character (and icons before it)
+        first_char_index = 0
+        while first_char_index in icon_indexes:
+            first_char_index += 1
+        cut = max(cut, first_char_index)
+
+        icons_before_cut = bisect.bisect_left(icon_indexes, cut)
+        return (line.plain[:cut - icons_before_cut],
+                "".join(characters[cut:]))
 
     def do_text_replacements(self, text, warn_func):
-        flagged = set()
-        for flagname, flagfunc in self.to_flag:
-            if flagfunc(text):
-                flagged.add(flagname)
-                warn_func("warn",
-                          "badness '%s' in text before substs" % flagname)
+        flagged = self.to_flag.find_matching(text)
+        for flagname in flagged:
+            warn_func("warn",
+                      "badness '%s' in text before substs" % flagname)
 
+        original_text = text
         text = common.trim_annotations(text)
-        for repl in self.replacements:
-            text = repl(text)
+        text = self.replacements.apply(text)
+        if text == original_text:
+            return text
 
-        for flagname, flagfunc in self.to_flag:
-            if flagname not in flagged and flagfunc(text):
+        for flagname in self.to_flag.find_matching(text):
+            if flagname not in flagged:
                 warn_func("warn",
                           "badness '%s' in text after substs" % flagname)
         return text
@@ -669,16 +1114,86 @@ class Checker(CheckerLexer):
         self.check_boxes(lines, boxtype, metrics, warn_func)
 
 
+class CheckCache:
+    """Errors found by previous checks of the entries of a pack.
+
+    Each entry is stored along with a hash of what its check depends on,
+    the paths it referenced with \\v and a hash of their values at that time.
+    The file also stores a hash of the checker settings, a cache made with
+    different settings is ignored.
+    """
+    # increase this when checks change, so that old caches are ignored.
+    version = 1
+
+    def __init__(self, path, settings, reuse=True):
+        """Load the cache from path, unless reuse is false"""
+        self.path = path
+        self.settings_hash = self.hash_json([self.version, settings])
+        self.entries = {}
+        if not reuse or not os.path.exists(path):
+            return
+        try:
+            cached = common.load_json(path)
+        except (OSError, ValueError) as exc:
+            print("ignoring check cache %s: %s" % (path, exc),
+                  file=sys.stderr)
+            return
+        if cached.get("settings") == self.settings_hash:
+            self.entries = cached["entries"]
+
+    @staticmethod
+    def hash_json(value):
+        serialized = json.dumps(value, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+    def lookup(self, file_dict_path_str, entry_hash, hash_references):
+        """Return the cached errors of an entry, or None if it is outdated.
+
+        hash_references(references) must return the current hash of the
+        values of these references."""
+        cached = self.entries.get(file_dict_path_str)
+        if cached is None or cached["hash"] != entry_hash:
+            return None
+        references = cached["references"]
+        if (references and hash_references(references)
+                != cached["references_hash"]):
+            return None
+        return [tuple(record) for record in cached["errors"]]
+
+    def store(self, file_dict_path_str, entry_hash, references,
+              references_hash, errors):
+        self.entries[file_dict_path_str] = {
+            "hash": entry_hash,
+            "references": references,
+            "references_hash": references_hash,
+            "errors": errors
+        }
+
+    def save(self, file_dict_path_strs):
+        """Save the cache, keeping only these entries"""
+        entries = {file_dict_path_str: self.entries[file_dict_path_str]
+                   for file_dict_path_str in file_dict_path_strs
+                   if file_dict_path_str in self.entries}
+        common.save_json(self.path, {"settings": self.settings_hash,
+                                     "entries": entries})
+
+
 class PackChecker(Checker):
     def __init__(self, sparse_reader, check_settings):
         super().__init__(check_settings)
         self.sparse_reader = sparse_reader
+        self.check_settings = check_settings
+        # If a list, get_text functions append the file_dict_path_str they
+        # resolve to it.
+        self.reference_sink = None
 
-    def check_pack(self, pack):
-
+    def make_get_text(self, pack):
+        """Return a function resolving \\v references using pack"""
         def get_text(file_path, dict_path, warn_func):
             file_dict_path_str = common.serialize_dict_path(file_path,
                                                             dict_path)
+            if self.reference_sink is not None:
+                self.reference_sink.append(file_dict_path_str)
 
             orig = self.sparse_reader.get(file_path, dict_path)
             if orig is None:
@@ -690,51 +1205,252 @@ class PackChecker(Checker):
                               file_dict_path_str))
                 return orig
             return trans['text']
+        return get_text
 
-        for file_dict_path_str, trans in pack.get_all().items():
-            comp = self.sparse_reader.get_complete_by_str(file_dict_path_str)
-            orig_langlabel, (file_path, dict_path), reverse_path = comp
+    def check_pack(self, pack, jobs=1, cache=None):
+        """Check every entry of a pack, using jobs processes.
 
-            if orig_langlabel is None:
-                orig_langlabel = {}
-                tags = ("unknown",)
-            elif isinstance(reverse_path, dict) and "tags" in reverse_path:
-                tags = reverse_path["tags"].split(' ')
-            else:
-                tags = tagger.find_tags(file_path, dict_path, reverse_path)
-
-            true_orig = orig_langlabel.get(self.sparse_reader.default_lang)
-            orig = trans.get("orig")
-            text = trans.get("text")
-
-            error = None
-            if true_orig is None:
-                error = "translation is stale: does not exist anymore"
-            elif orig is not None and true_orig != orig:
-                error = "translation is stale: original text differs"
-            elif orig is None:
-                orig = true_orig
-
-            if error is not None:
-                self.print_error(file_dict_path_str, "warn", error, text)
-
-            if not text:
-                if "ciphertext" in trans:
-                    self.print_error(file_dict_path_str, "notice",
-                                     "encrypted entries not supported", "")
-                elif true_orig:
-                    self.print_error(file_dict_path_str, "error",
-                                     "entry has no translation", "")
-                continue
+        If cache is a CheckCache, only check entries whose cached errors
+        are outdated, replay the others and update the cache.
+
+        With multiple processes or a cache, errors are still printed in pack
+        order, but only at the end."""
+        translations = pack.get_all()
+        if jobs <= 1 and cache is None:
+            get_text = self.make_get_text(pack)
+            for file_dict_path_str, trans in translations.items():
+                self.check_entry(file_dict_path_str, trans, get_text)
+            return
+
+        results = {}
+        to_check = translations
+        if cache is not None:
+            entry_hashes = {}
+            to_check = []
+            for file_dict_path_str, trans in translations.items():
+                entry_hash = self.hash_entry(file_dict_path_str, trans)
+                entry_hashes[file_dict_path_str] = entry_hash
+                errors = cache.lookup(
+                    file_dict_path_str, entry_hash,
+                    lambda refs: self.hash_references(pack, refs))
+                if errors is None:
+                    to_check.append(file_dict_path_str)
+                else:
+                    results[file_dict_path_str] = errors
+
+        checked = self.check_entries(pack, to_check, jobs)
+        for file_dict_path_str, errors, references in checked:
+            results[file_dict_path_str] = errors
+            if cache is not None:
+                cache.store(file_dict_path_str,
+                            entry_hashes[file_dict_path_str], references,
+                            self.hash_references(pack, references), errors)
+
+        for file_dict_path_str in translations:
+            for record in results.get(file_dict_path_str, ()):
+                self.print_error(*record)
+        if cache is not None:
+            cache.save(translations)
+
+    def check_entries(self, pack, paths, jobs=1):
+        """Check these entries of the pack, without printing anything.
+
+        Return a list of (file_dict_path_str, errors, references), see
+        collect_errors().  With jobs > 1, entries are checked by that many
+        processes, if the platform allows it."""
+        if jobs > 1 and len(paths) > 1:
+            try:
+                import multiprocessing
+                # workers inherit the checker and pack instead of pickling
+                context = multiprocessing.get_context("fork")
+            except ValueError:
+                jobs = 1
+        if jobs <= 1 or len(paths) <= 1:
+            return self.collect_errors(pack, paths)
+
+        import concurrent.futures
+        checked = []
+        with concurrent.futures.ProcessPoolExecutor(
+                jobs, mp_context=context, initializer=init_check_worker,
+                initargs=(self, pack)) as executor:
+            # a few shards per process, so that a big shard does not
+            # leave other processes waiting at the end.
+            shards = self.shard_by_file(paths, jobs * 4)
+            for shard_results, rule_stats in executor.map(
+                    check_entries_in_worker, shards):
+                checked.extend(shard_results)
+                self.other_rule_stats.extend(rule_stats)
+        return checked
+
+    @staticmethod
+    def find_changes(old_translations, new_translations):
+        """Return the set of entries added, modified or removed between two
+        results of PackFile.get_all()"""
+        changed = set(old_translations.keys() ^ new_translations.keys())
+        for file_dict_path_str, trans in new_translations.items():
+            old_trans = old_translations.get(file_dict_path_str)
+            if old_trans is not None and old_trans != trans:
+                changed.add(file_dict_path_str)
+        return changed
+
+    @staticmethod
+    def find_dependents(references, changed):
+        """Return the entries whose \\v references resolve to changed entries.
+
+        references maps entries to the references collected when they were
+        checked, see collect_errors()."""
+        return {file_dict_path_str
+                for file_dict_path_str, refs in references.items()
+                if not changed.isdisjoint(refs)}
+
+    def cache_settings(self):
+        """Return what the errors of every entry depend on, for CheckCache"""
+        return {"checker": type(self).__name__,
+                "settings": self.check_settings,
+                "from_locale": self.sparse_reader.default_lang,
+                # errors embed color codes
+                "colors": len(self.colors) > 1}
+
+    def hash_entry(self, file_dict_path_str, trans):
+        """Hash what the check of an entry depends on, except references"""
+        file_path, dict_path, true_orig, tags = self.lookup_entry(
+            file_dict_path_str)
+        return CheckCache.hash_json([file_dict_path_str, trans, true_orig,
+                                     list(tags)])
+
+    def hash_references(self, pack, file_dict_path_strs):
+        """Hash the current values of texts referenced with \\v"""
+        values = []
+        for file_dict_path_str in file_dict_path_strs:
+            file_path, dict_path = common.unserialize_dict_path(
+                file_dict_path_str)
+            orig = self.sparse_reader.get(file_path, dict_path)
+            trans = None
+            if orig is not None:
+                trans = pack.get(file_dict_path_str, orig)
+            text = None if trans is None else trans.get("text")
+            values.append([orig, trans is not None, text])
+        return CheckCache.hash_json(values)
+
+    @staticmethod
+    def shard_by_file(translations, count):
+        """Split translations into at most count lists of file_dict_path_str
+
+        Strings of the same game file are in the same shard, so that sparse
+        readers only read each file once."""
+        import heapq
+        by_file = {}
+        for file_dict_path_str in translations:
+            file_str = common.split_file_dict_path(file_dict_path_str)[0]
+            by_file.setdefault(file_str, []).append(file_dict_path_str)
+
+        # put the biggest files first into the smallest shard
+        shards = [(0, index, []) for index in range(count)]
+        for paths in sorted(by_file.values(), key=len, reverse=True):
+            size, index, shard = heapq.heappop(shards)
+            shard.extend(paths)
+            heapq.heappush(shards, (size + len(paths), index, shard))
+        return [shard for _, _, shard in sorted(shards, key=lambda s: s[1])
+                if shard]
+
+    def collect_errors(self, pack, file_dict_path_strs):
+        """Check some entries of a pack and return their errors.
+
+        Return a list of (file_dict_path_str, errors, references) for each
+        entry, where errors are records suitable for print_error(*record)
+        and references are the file_dict_path_str referenced with \\v"""
+        get_text = self.make_get_text(pack)
+        translations = pack.get_all()
+        results = []
+        try:
+            for file_dict_path_str in file_dict_path_strs:
+                self.error_sink = []
+                self.reference_sink = []
+                self.check_entry(file_dict_path_str,
+                                 translations[file_dict_path_str], get_text)
+                results.append((file_dict_path_str, self.error_sink,
+                                self.reference_sink))
+        finally:
+            self.error_sink = None
+            self.reference_sink = None
+        return results
+
+    def lookup_entry(self, file_dict_path_str):
+        """Return file_path, dict_path, original text and tags of an entry
+
+        The original text is None if it does not exist in the game."""
+        comp = self.sparse_reader.get_complete_by_str(file_dict_path_str)
+        orig_langlabel, (file_path, dict_path), reverse_path = comp
+
+        if orig_langlabel is None:
+            orig_langlabel = {}
+            tags = ("unknown",)
+        elif isinstance(reverse_path, dict) and "tags" in reverse_path:
+            tags = reverse_path["tags"].split(' ')
+        else:
+            tags = tagger.find_tags(file_path, dict_path, reverse_path)
+
+        true_orig = orig_langlabel.get(self.sparse_reader.default_lang)
+        return file_path, dict_path, true_orig, tags
+
+    def check_entry(self, file_dict_path_str, trans, get_text):
+        """Check a single entry of a pack, get_text is from make_get_text()"""
+        file_path, dict_path, true_orig, tags = self.lookup_entry(
+            file_dict_path_str)
+        orig = trans.get("orig")
+        text = trans.get("text")
+
+        error = None
+        if true_orig is None:
+            error = "translation is stale: does not exist anymore"
+        elif orig is not None and true_orig != orig:
+            error = "translation is stale: original text differs"
+        elif orig is None:
+            orig = true_orig
+
+        if error is not None:
+            self.print_error(file_dict_path_str, "warn", error, text)
+
+        if not text:
+            if "ciphertext" in trans:
+                self.print_error(file_dict_path_str, "notice",
+                                 "encrypted entries not supported", "")
+            elif true_orig:
+                self.print_error(file_dict_path_str, "error",
+                                 "entry has no translation", "")
+            return
+
+        self.check_text(file_path, dict_path, text, orig, tags, get_text)
+
+
+# PackChecker and pack of check worker processes, see init_check_worker()
+check_worker_state = None
+
+
+def init_check_worker(checker, pack):
+    """Initialize a check worker process with the checker and pack to use"""
+    global check_worker_state
+    check_worker_state = (checker, pack)
+
+
+def check_entries_in_worker(file_dict_path_strs):
+    """Check entries in a check worker process
 
-            self.check_text(file_path, dict_path, text, orig, tags, get_text)
+    Return their errors and the statistics of rules used to check them."""
+    checker, pack = check_worker_state
+    results = checker.collect_errors(pack, file_dict_path_strs)
+    return results, checker.get_rule_stats(reset=True)
 
 
-def check_assets(sparse_reader, check_settings, assets_path, from_locale):
+def check_assets(sparse_reader, check_settings, assets_path, from_locale,
+                 output=None):
     """Hack to check original game assets.
 
-    most checks won't detect anything when used that way."""
+    most checks won't detect anything when used that way.
+    Errors are written to output if it is a DiagnosticsOutput."""
     checker = Checker(check_settings)
+    if output is not None:
+        checker.output = output
     it = common.walk_assets_for_translatables(assets_path, from_locale)
     for langlabel, (file_path, dict_path), reverse_path in it:
         orig = langlabel[from_locale]
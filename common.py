@@ -4,14 +4,83 @@ import os
 import os.path
 import sys
 import json
+import queue
+import threading
+import collections
 import tags as tagger
 
-def load_json(path):
+class StringInterner:
+    """Share equal strings between loaded json values.
+
+    json creates a new string for each occurrence of a text, but packs and
+    caches repeat the same texts (and lang label keys) a lot.  Pass the same
+    interner to every load_json() call whose results are kept in memory
+    together, so they share a single copy of each string.
+
+    An interner keeps every string it has seen.  To load something again
+    and again next to long-lived data, use a new interner created with the
+    long-lived data's interner as base: strings of the base are reused, but
+    nothing is added to it."""
+    def __init__(self, base=None):
+        self.table = {}
+        self.base_table = {} if base is None else base.table
+        self.duplicates = 0
+        self.saved_bytes = 0
+
+    def intern(self, string):
+        existing = self.base_table.get(string)
+        if existing is None:
+            existing = self.table.setdefault(string, string)
+        if existing is not string:
+            self.duplicates += 1
+            self.saved_bytes += sys.getsizeof(string)
+        return existing
+
+    def intern_value(self, value):
+        if value.__class__ is str:
+            return self.intern(value)
+        if value.__class__ is list:
+            return [self.intern(item) if item.__class__ is str else item
+                    for item in value]
+        return value
+
+    def object_pairs_hook(self, pairs):
+        """object_pairs_hook for json.load(), nested objects are already
+        interned when they are passed here."""
+        # json already shares keys inside a file, so only count values.
+        intern_value = self.intern_value
+        return {self.intern_key(key): intern_value(value)
+                for key, value in pairs}
+
+    def intern_key(self, key):
+        existing = self.base_table.get(key)
+        if existing is None:
+            existing = self.table.setdefault(key, key)
+        return existing
+
+    def report(self):
+        """Return a one line description of the memory saved so far.
+
+        Keys shared between files are not counted, so this is a lower
+        bound."""
+        table_size = sys.getsizeof(self.table)
+        return ("interned %d duplicate strings, saving %d KiB"
+                " (minus %d KiB for the table of %d strings)" % (
+                    self.duplicates, self.saved_bytes // 1024,
+                    table_size // 1024, len(self.table)))
+
+
+def load_json(path, interner=None):
     """Load a json file given a path.
 
+    If interner is a StringInterner, use it to share strings.
+
     Can raise both OSError and json.ValueError (extends ValueError)"""
     try:
         with open(path, encoding="utf-8") as fd:
+            if interner is not None:
+                return json.load(fd,
+                                 object_pairs_hook=interner.object_pairs_hook)
             return json.load(fd)
     except:
         print("Error while parsing %s:" % path, file=sys.stderr)
@@ -25,6 +94,97 @@ def save_json(path, value):
     """Save a readable json value into the given path."""
     save_json_to_fd(open(path, 'w', encoding="utf-8"), value)
 
+def iterate_json_object(path, chunk_size=65536):
+    """Iterate over the items of a json file containing a single object
+
+    Yields (key, value) in file order, while only keeping a few chunks of
+    the file in memory.  This raises ValueError if the file is not a valid
+    json object, but possibly after yielding the items preceding the error.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as fd:
+        buffer = ""
+        index = 0
+
+        def fill():
+            """Read more data, return False on EOF"""
+            nonlocal buffer, index
+            chunk = fd.read(chunk_size)
+            buffer = buffer[index:] + chunk
+            index = 0
+            return bool(chunk)
+
+        def skip_spaces():
+            """Skip whitespace and return the next character or '' on EOF"""
+            nonlocal index
+            while True:
+                while index < len(buffer) and buffer[index] in ' \t\r\n':
+                    index += 1
+                if index < len(buffer):
+                    return buffer[index]
+                if not fill():
+                    return ''
+
+        def expect(chars):
+            nonlocal index
+            char = skip_spaces()
+            if not char or char not in chars:
+                raise ValueError("%s: expected %s, got %s at offset %d" % (
+                    path, " or ".join(map(repr, chars)), repr(char), index))
+            index += 1
+            return char
+
+        def decode():
+            nonlocal index
+            skip_spaces()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, index)
+                except json.JSONDecodeError:
+                    if fill():
+                        continue
+                    raise
+                # a number near the end of the buffer may be truncated, e.g.
+                # "1e" is decoded as 1 when "1e10" follows.
+                if (isinstance(value, (int, float)) and len(buffer) - end < 4
+                        and fill()):
+                    continue
+                index = end
+                return value
+
+        try:
+            expect('{')
+            if skip_spaces() == '}':
+                return
+            while True:
+                key = decode()
+                if not isinstance(key, str):
+                    raise ValueError("%s: object key is not a string" % path)
+                expect(':')
+                yield key, decode()
+                if expect(',}') == '}':
+                    return
+        except ValueError:
+            print("Error while parsing %s:" % path, file=sys.stderr)
+            raise
+
+def save_json_items(path, items):
+    """Save an iterable of (key, value) as a json object into the given path.
+
+    The result is the same as save_json(path, dict(items)), but items are
+    written as soon as they are iterated."""
+    with open(path, 'w', encoding="utf-8") as fd:
+        fd.write('{')
+        separator = ''
+        for key, value in items:
+            text = json.dumps({key: value}, indent=8, separators=(',', ': '),
+                              ensure_ascii=False)
+            # strip the '{' and '\n}' of the single item object
+            fd.write(separator)
+            fd.write(text[1:-2])
+            separator = ','
+        fd.write('\n}' if separator else '}')
+
 if sys.version_info < (3, 7):
     # a note about dicts and load/save_json:
     # Since Python 3.6, the CPython dict's new clever implementation comes with
@@ -61,6 +221,63 @@ def drain_dict(input_dict):
     while array:
         yield array.pop()
 
+class BackgroundIterator:
+    """Iterate over an iterable in a background thread.
+
+    Up to maxsize items are produced in advance, while the consumer handles
+    the previous ones.  If the iterable raises an exception, next() raises
+    it again after the items preceding it were consumed."""
+    # marks the end of the iteration, with the exception if any
+    _end = object()
+
+    def __init__(self, iterable, maxsize=64):
+        self.queue = queue.Queue(maxsize)
+        self.stopping = False
+        self.finished = False
+        self.thread = threading.Thread(target=self.produce, args=(iterable,),
+                                       daemon=True)
+        self.thread.start()
+
+    def produce(self, iterable):
+        try:
+            for item in iterable:
+                if not self.put((item, None)):
+                    return
+        except BaseException as exc:
+            self.put((self._end, exc))
+            return
+        self.put((self._end, None))
+
+    def put(self, record):
+        """Queue a record, return False if close() was called meanwhile"""
+        while not self.stopping:
+            try:
+                self.queue.put(record, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        item, exc = self.queue.get()
+        if item is self._end:
+            self.finished = True
+            if exc is not None:
+                raise exc
+            raise StopIteration
+        return item
+
+    def close(self):
+        """Stop iterating.  The thread stops when it produces its next item.
+        """
+        self.stopping = True
+        self.finished = True
+
 def walk_json_inner(json_obj, dict_path=None, reverse_path=None):
     """Walk into a JSON object and yield every sub-object encountered
 
@@ -516,9 +733,9 @@ class string_cache:
     def __init__(self, default_lang=None):
         self.data = {}
         self.default_lang = default_lang
-    def load_from_file(self, filename, langs=None):
+    def load_from_file(self, filename, langs=None, interner=None):
         # a streaming parser would be ideal here... but this will do.
-        self.data = load_json(filename)
+        self.data = load_json(filename, interner)
         if langs is not None:
             self.filter_lang(langs)
     def filter_lang(self, langs):
@@ -528,10 +745,27 @@ class string_cache:
         for file_dict_path_str, entry in drain_dict(self.data):
             splitted_path = unserialize_dict_path(file_dict_path_str)
             yield entry["langlabel"], splitted_path, file_dict_path_str, entry
+    @staticmethod
+    def iterate_file(filename, langs=None):
+        """Like load_from_file() followed by iterate_drain(), but stream it
+
+        Entries are yielded while the file is parsed and are not kept."""
+        for file_dict_path_str, entry in iterate_json_object(filename):
+            if langs is not None:
+                filter_langlabel(entry["langlabel"], langs)
+            splitted_path = unserialize_dict_path(file_dict_path_str)
+            yield entry["langlabel"], splitted_path, file_dict_path_str, entry
     def iterate(self):
         for file_dict_path_str, entry in self.data.items():
             splitted_path = unserialize_dict_path(file_dict_path_str)
             yield entry["langlabel"], splitted_path, file_dict_path_str, entry
+    def iterate_order(self):
+        """Yield (file_dict_path_str, ordinal) in game order
+
+        The ordinal is the "order" field written by save_cache, or the
+        position of the entry in the cache for caches without it."""
+        for index, (file_dict_path_str, entry) in enumerate(self.data.items()):
+            yield file_dict_path_str, entry.get("order", index)
 
     def add(self, file_dict_path_str, lang_label_like, extra=None):
         entry = {"langlabel": lang_label_like}
@@ -579,19 +813,23 @@ class PackFile:
         # dict from serialized file_dict_path to translation object
         # (e.g. {"orig": orig, "text": new})
         self.translations = {}
-        # Index from orig to an object in self.translations
+        # Index from orig to the file_dict_path_str of the translations of
+        # this orig, in an OrderedDict used as an ordered set.  The last one
+        # is the last added one.
         self.translation_index = {}
         # Statistics about badnesses
         self.quality_stats = {"bad": 0, "incomplete": 0,
                               "unknown": 0, "wrong": 0, "spell": 0}
+        # Number of translations per file_str
+        self.file_stats = {}
 
-    def load(self, filename, on_each_text_load=lambda x: None):
+    def load(self, filename, on_each_text_load=lambda x: None,
+             interner=None):
         self.reset()
 
-        self.translations = load_json(filename)
-        for entry in self.translations.values():
-            self.translation_index[entry['orig']] = entry
-            self.add_quality_stat(entry)
+        for file_dict_path_str, entry in load_json(filename,
+                                                   interner).items():
+            self.set_entry(file_dict_path_str, entry)
             on_each_text_load(entry)
 
     def save(self, filename):
@@ -607,26 +845,66 @@ class PackFile:
         if qual is not None:
             self.quality_stats[qual] += shift
 
+    def index_entry(self, file_dict_path_str, entry, shift=1):
+        """Add (or remove if shift is -1) an entry to indexes and stats"""
+        orig = entry.get("orig")
+        if orig is not None:
+            paths = self.translation_index.get(orig)
+            if shift > 0:
+                if paths is None:
+                    paths = self.translation_index[orig] = (
+                        collections.OrderedDict())
+                paths[file_dict_path_str] = None
+            elif paths is not None:
+                paths.pop(file_dict_path_str, None)
+                if not paths:
+                    del self.translation_index[orig]
+        self.add_quality_stat(entry, shift)
+
+        file_str = split_file_dict_path(file_dict_path_str)[0]
+        count = self.file_stats.get(file_str, 0) + shift
+        if count:
+            self.file_stats[file_str] = count
+        else:
+            del self.file_stats[file_str]
+
+    def set_entry(self, file_dict_path_str, entry):
+        """Add or replace an entry, keeping indexes and stats up to date"""
+        old_entry = self.translations.get(file_dict_path_str)
+        if old_entry is not None:
+            self.index_entry(file_dict_path_str, old_entry, -1)
+        self.translations[file_dict_path_str] = entry
+        self.index_entry(file_dict_path_str, entry)
+
     def add_incomplete_translation(self, dict_path_str, orig,
                                    incomplete_entry):
         assert 'text' not in incomplete_entry
         incomplete_entry["orig"] = orig
         incomplete_entry = sort_pack_entry(incomplete_entry)
-        self.translations[dict_path_str] = incomplete_entry
-        self.add_quality_stat(incomplete_entry)
+        self.set_entry(dict_path_str, incomplete_entry)
 
     def add_translation(self, dict_path_str, orig, new_entry):
         new_entry["orig"] = orig
         new_entry = sort_pack_entry(new_entry)
-        if dict_path_str in self.translations:
-            self.add_quality_stat(self.translations[dict_path_str], -1)
-        self.translations[dict_path_str] = new_entry
-        self.add_quality_stat(new_entry)
-        # this may erase duplicates, but may be more fitting to the context
-        self.translation_index[orig] = new_entry
+        self.set_entry(dict_path_str, new_entry)
 
     def get_by_orig(self, orig):
-        return self.translation_index.get(orig)
+        """Return the last added translation of orig, or None.
+
+        It may be incomplete, see get_all_by_orig() for the others."""
+        paths = self.translation_index.get(orig)
+        if not paths:
+            return None
+        return self.translations[next(reversed(paths))]
+
+    def get_all_by_orig(self, orig):
+        """Return a dict of all translations of orig, incomplete or not.
+
+        It maps file_dict_path_str to translations, from the first to the
+        last added one."""
+        paths = self.translation_index.get(orig, ())
+        return {file_dict_path_str: self.translations[file_dict_path_str]
+                for file_dict_path_str in paths}
 
     def get(self, file_dict_path_str, orig_text=None):
         ret = self.translations.get(file_dict_path_str)
@@ -658,6 +936,7 @@ class PackFile:
         for qual, count in self.quality_stats.items():
             ret += "%6i %s(%s)\n" % (count, desc[qual], qual)
         ret += format_stat(uniques, config.unique_count, "uniques")
+        ret += "\n%6i files with translations" % len(self.file_stats)
         return ret
 
 class GameWalker:
@@ -668,21 +947,23 @@ class GameWalker:
     """
 
     def __init__(self, game_dir=None, string_cache_path=None,
-                 loaded_string_cache=None, from_locale="en_US"):
+                 loaded_string_cache=None, from_locale="en_US",
+                 interner=None):
         self.string_cache = loaded_string_cache
         self.assets_dir = None
         self.file_path_filter = self.yes_filter
         self.dict_path_filter = self.yes_filter
         self.tags_filter = self.yes_filter
         self.orig_filter = self.yes_filter
-        self.custom_filter = lambda path, langlabel: True
+        self.custom_filter = self.yes_custom_filter
         self.from_locale = from_locale
         if loaded_string_cache is not None:
             return
         if string_cache_path and os.path.exists(string_cache_path):
             try:
                 self.string_cache = string_cache(from_locale)
-                self.string_cache.load_from_file(string_cache_path)
+                self.string_cache.load_from_file(string_cache_path,
+                                                 interner=interner)
                 return
             except:
                 pass
@@ -700,6 +981,14 @@ class GameWalker:
             iterator = self.string_cache.iterate_drain()
         else:
             iterator = self.string_cache.iterate()
+        return self.filter_cache_items(iterator)
+
+    def walk_cache_file(self, filename, langs=None):
+        """Walk a string cache file while parsing it, see walk_cache"""
+        return self.filter_cache_items(string_cache.iterate_file(filename,
+                                                                 langs))
+
+    def filter_cache_items(self, iterator):
         for langlabel, (file_path,
                         dict_path), file_dict_path_str, extra in iterator:
             if not self.file_path_filter(file_path):
@@ -755,53 +1044,77 @@ class GameWalker:
         This yields file_dict_path_str and entries instead of yielding
         langlabel, (file_path, dict_path), reverse_path_or_info
         """
-
-        sparse_reader = self.string_cache
-        if sparse_reader is None:
-            sparse_reader = sparse_dict_path_reader(self.game_dir,
-                                                    self.from_locale)
-
-        def filter_tags_and_custom_full(file_dict_path_str):
-            complete = sparse_reader.get_complete_by_str(file_dict_path_str)
-            if not complete:
-                return None
-            langlabel, (file_path, dict_path), rev_path_or_info = complete
-            if self.tags_filter is not None:
-                if isinstance(rev_path_or_info,
-                              dict) and "tags" in rev_path_or_info:
-                    tags = rev_path_or_info["tags"].split(" ")
-                elif isinstance(rev_path_or_info, list):
-                    tags = tagger.find_tags(file_path, dict_path,
-                                            rev_path_or_info)
-                else:
-                    tags = ()
-                if not self.tags_filter(tags):
-                    return None
-            if not self.custom_filter(file_dict_path_str, langlabel):
-                return None
-
-            return file_path, dict_path
-
-        filter_tags_and_custom = filter_tags_and_custom_full
-
-        if (self.tags_filter is self.yes_filter
-                and self.custom_filter is self.yes_filter):
-            filter_tags_and_custom = split_file_dict_path
-
+        # cheap filters first, so only survivors need tags and lang labels
+        survivors = []
         for file_dict_path_str, entry in pack.items():
-            file_path_dict_path = filter_tags_and_custom(file_dict_path_str)
-            if file_path_dict_path is None:
-                continue
-            file_path, dict_path = file_path_dict_path
+            file_path, dict_path = unserialize_dict_path(file_dict_path_str)
             if not self.file_path_filter(file_path):
                 continue
             if not self.dict_path_filter(dict_path):
                 continue
             if not self.orig_filter((entry.get('orig',''),)):
                 continue
+            survivors.append((file_dict_path_str, file_path, dict_path,
+                              entry))
 
+        if (self.tags_filter is self.yes_filter
+                and self.custom_filter is self.yes_custom_filter):
+            for file_dict_path_str, _, _, entry in survivors:
+                yield file_dict_path_str, entry
+            return
+
+        infos = self.get_langlabels_and_tags(
+            (file_dict_path_str, file_path, dict_path)
+            for file_dict_path_str, file_path, dict_path, _ in survivors)
+
+        for file_dict_path_str, _, _, entry in survivors:
+            langlabel, tags = infos[file_dict_path_str]
+            if not self.tags_filter(tags):
+                continue
+            if not self.custom_filter(file_dict_path_str, langlabel):
+                continue
             yield file_dict_path_str, entry
 
+    def get_langlabels_and_tags(self, paths):
+        """Find lang labels and tags of many strings in one go.
+
+        paths must be an iterable of (file_dict_path_str, file_path,
+        dict_path).  Return a dict from file_dict_path_str to (langlabel,
+        tags).  langlabel is None and tags is () for unknown strings.
+
+        With a string cache, these are simple lookups.  Otherwise, strings
+        are grouped by file, so that each game file is read only once."""
+        infos = {}
+        if self.string_cache is not None:
+            data = self.string_cache.data
+            for file_dict_path_str, _, _ in paths:
+                entry = data.get(file_dict_path_str)
+                if entry is None:
+                    infos[file_dict_path_str] = (None, ())
+                    continue
+                tags = entry["tags"].split(" ") if "tags" in entry else ()
+                infos[file_dict_path_str] = (entry.get("langlabel"), tags)
+            return infos
+
+        sparse_reader = sparse_dict_path_reader(self.game_dir,
+                                                self.from_locale)
+        by_file = {}
+        for file_dict_path_str, file_path, dict_path in paths:
+            by_file.setdefault(tuple(file_path), []).append(
+                (file_dict_path_str, dict_path))
+
+        for file_path, strings in by_file.items():
+            file_path = list(file_path)
+            for file_dict_path_str, dict_path in strings:
+                complete = sparse_reader.get_complete(file_path, dict_path)
+                langlabel, _, reverse_path = complete
+                if langlabel is None:
+                    infos[file_dict_path_str] = (None, ())
+                    continue
+                tags = tagger.find_tags(file_path, dict_path, reverse_path)
+                infos[file_dict_path_str] = (langlabel, tags)
+        return infos
+
     def set_file_path_filter(self, array):
         self.file_path_filter = self.make_filter(array)
 
@@ -826,6 +1139,10 @@ class GameWalker:
     def yes_filter(something):
         return True
 
+    @staticmethod
+    def yes_custom_filter(file_dict_path_str, langlabel):
+        return True
+
     @classmethod
     def make_filter(cls, array):
         if not array:
@@ -76,8 +76,10 @@ class GrammalecteChecker(checker.PackChecker):
         self.grammalecte_replacements_before = before
         self.grammalecte_replacements_after = after
 
-        self.dont_print = dont_print
-        self.all_the_errors = {}
+        # keeps errors by file_dict_path_str, in errors_by_path
+        self.collected = checker.CollectingOutput(
+            None if dont_print else self.output)
+        self.output = self.collected
         self.all_spells = {}
         self.spell_count = 0
         self.grammar_count = 0
@@ -112,14 +114,6 @@ class GrammalecteChecker(checker.PackChecker):
         spellchecker.activatePersonalDictionary()
         assert spellchecker.bPersonalDic
 
-    def print_error(self, file_dict_path_str, severity, error, text):
-        a = self.all_the_errors.setdefault(file_dict_path_str, [])
-        a.append((severity, error, text))
-        if self.dont_print:
-            return
-        super().print_error(file_dict_path_str, severity, error, text)
-
-
     def check_paragraph(self, paragraph, warn_func):
         if paragraph in self.whitelist:
             return
@@ -142,19 +136,14 @@ class GrammalecteChecker(checker.PackChecker):
 
     @staticmethod
     def prepare_replacements(repls):
-
-        def make_replacer(litteral_or_regex, repl):
-            regex = re.compile(litteral_or_regex)
-            return lambda text: regex.sub(repl, text)
-
-        return [make_replacer(replace_this, with_this)
-                for replace_this, with_this in repls]
+        rules = checker.ReplacementRules()
+        for replace_this, with_this in repls:
+            rules.add_rule(replace_this, re.compile(replace_this), with_this)
+        return rules
 
     @staticmethod
     def do_replacements(text, replacements):
-        for func in replacements:
-            text = func(text)
-        return text
+        return replacements.apply(text)
 
     def do_all_replacements(self, text, warn_func):
         text = text.strip()
@@ -191,6 +180,7 @@ grammar_checker = GrammalecteChecker(sparse_reader, settings.get('check', {}),
 french = common.PackFile()
 french.load(settings["packfile"])
 grammar_checker.check_pack(french)
+grammar_checker.output.finish()
 
 print("Translations with errors: ", len(grammar_checker.all_spells))
 print("Grammar mistakes: ", grammar_checker.grammar_count)
@@ -205,7 +195,8 @@ for badword, count in itertools.islice(iterator, 30):
 # hack: save another pack with errors as note, with quality 'spell'.
 
 patch_me = common.load_json(settings["packfile"])
-for file_dict_path_str, errors in grammar_checker.all_the_errors.items():
+errors_by_path = grammar_checker.collected.errors_by_path
+for file_dict_path_str, errors in errors_by_path.items():
     grammar_errors = []
     for severity, error, text in errors:
         if error == "grammar error" or error == "spelling error":
@@ -2,14 +2,21 @@
 
 import re
 import os
+import io
 import sys
+import copy
+import json
+import time
+import signal
+import socket
 import common
 import itertools
+import contextlib
 
 from readliner import Readliner
 
 import tags as tagger
-from checker import PackChecker, check_assets
+from checker import PackChecker, CheckCache, check_assets, output_formats
 
 class PackFile(common.PackFile):
     def save(self, filename):
@@ -17,8 +24,9 @@ class PackFile(common.PackFile):
         super().save(filename)
         print(" ok.")
 
-    def load(self, filename, on_each_text_load=lambda x: None):
-        super().load(filename, on_each_text_load)
+    def load(self, filename, on_each_text_load=lambda x: None,
+             interner=None):
+        super().load(filename, on_each_text_load, interner)
         print("loaded", filename)
         print(self.get_stats(config))
 
@@ -127,6 +135,8 @@ class Configuration:
     def __init__(self):
         self.reset()
         self.check()
+        # shares strings between the pack and the string cache
+        self.interner = common.StringInterner()
 
     default_options = {
         "gamedir": ".",
@@ -146,7 +156,10 @@ class Configuration:
         "packfile": "translations.pack.json",
         "total_count": 0,
         "unique_count": 0,
-        "history_size": 200
+        "history_size": 200,
+        "daemon_socket": "jsontr.sock",
+        "check_cache_file": "",
+        "lookahead": 16
     }
 
     def add_options_to_argparser(self, parser):
@@ -246,6 +259,23 @@ class Configuration:
                             when using ":e".  If not specified, then the EDITOR
                             environment variable is used if it exist.""")
 
+        parser.add_argument("--daemon-socket", dest="daemon_socket",
+                            metavar="<socket path>", help="""Unix socket
+                            where the 'daemon' command listens, and where
+                            'get', 'count' and 'check' look for a running
+                            daemon.  Defaults to jsontr.sock.  An empty
+                            value disables the daemon.""")
+        parser.add_argument("--check-cache-file", dest="check_cache_file",
+                            metavar="<path to cache file>", help="""Where
+                            'check' remembers the errors of each entry, so
+                            that only modified entries are checked again.
+                            'check' updates it every time.  There is no
+                            cache by default, or with an empty value.""")
+        parser.add_argument("--lookahead", dest="lookahead", type=int,
+                            metavar="<count>", help="""Number of strings
+                            to find and prepare for display in advance
+                            while translating.  Defaults to 16.""")
+
         parser.add_argument("--pack-file", required=False, dest="packfile",
                             metavar="<pack file>",
                             help="""Pack file to create/edit/update. Required
@@ -302,10 +332,23 @@ class Configuration:
         walker = common.GameWalker(game_dir = self.gamedir)
         return walker.walk(self.from_locale, drain=True)
 
-    def iterate_over_configured_source(self, pack, no_cache = False):
-        string_cache = None
-        if not no_cache and os.path.exists(self.string_cache_file):
-            string_cache = self.load_string_cache()
+    def iterate_over_configured_source(self, pack, no_cache = False,
+                                       string_cache = None, drain = True,
+                                       stream = False):
+        """Iterate over the configured strings that should be translated.
+
+        If stream is true and the string cache must be loaded, it is parsed
+        while iterating instead, without printing anything, so that the
+        first strings come quickly."""
+        stream_file = None
+        if (string_cache is None and not no_cache
+                and os.path.exists(self.string_cache_file)):
+            if stream:
+                stream_file = self.string_cache_file
+                # an empty cache, so that the walker does not need the game
+                string_cache = common.string_cache(self.from_locale)
+            else:
+                string_cache = self.load_string_cache()
         walker = common.GameWalker(game_dir = self.gamedir,
                                    loaded_string_cache = string_cache)
         walker.set_file_path_filter(self.filter_file_path)
@@ -313,14 +356,18 @@ class Configuration:
         walker.set_tags_filter(self.filter_tags)
         walker.set_orig_filter(self.filter_orig)
         walker.set_custom_filter(self.get_trans_known_filter(pack))
-        return walker.walk(self.from_locale, drain=True)
+        if stream_file is not None:
+            langs = frozenset(self.locales_to_show + [self.from_locale])
+            return walker.walk_cache_file(stream_file, langs)
+        return walker.walk(self.from_locale, drain=drain)
 
     def load_string_cache(self):
         string_cache = common.string_cache(self.from_locale)
         langs = frozenset(self.locales_to_show + [self.from_locale])
         print("loading string cache %s"%(self.string_cache_file), end="...",
               flush=True)
-        string_cache.load_from_file(self.string_cache_file, langs)
+        string_cache.load_from_file(self.string_cache_file, langs,
+                                    self.interner)
         print(" ok")
         return string_cache
 
@@ -381,8 +428,15 @@ class Translator:
             'e': self.command_spawn_editor,
             's': self.command_show_stat,
         }
+        # see prepare_prompts()
+        self.prepare_count = 0
+        self.prepare_time = 0.
+        self.wait_count = 0
+        self.wait_time = 0.
 
-    def setup_autocomplete(self, strings):
+    @staticmethod
+    def find_completions(strings):
+        """Return the words and the entire completion string of strings"""
         words = set()
         string_set = set()
         for text in strings:
@@ -393,12 +447,17 @@ class Translator:
             for word in text.replace('\n', ' ').split(' '):
                 if word:
                     words.add(word)
-        self.readliner.set_complete_array(words)
 
         if len(string_set) == 1:
             entire_completion = string_set.pop()
         else:
             entire_completion = ""
+        return words, entire_completion
+
+    def setup_autocomplete(self, completions):
+        """Setup completion with a result of find_completions()"""
+        words, entire_completion = completions
+        self.readliner.set_complete_array(words)
         self.readliner.set_entire_completion_string(entire_completion)
 
     def setup_prefilled_text(self, real_known, stale, duplicate):
@@ -499,6 +558,14 @@ class Translator:
 
     def command_show_stat(self, ignored):
         print(self.pack.get_stats(self.config))
+        print(self.get_prepare_stats())
+
+    def get_prepare_stats(self):
+        return ("prepared %i prompts in %.3fs (%.2fms each), "
+                "waited %.3fs for %i strings" % (
+                    self.prepare_count, self.prepare_time,
+                    1000 * self.prepare_time / max(1, self.prepare_count),
+                    self.wait_time, self.wait_count))
 
     def command_quit(self, ignored):
         raise KeyboardInterrupt()
@@ -557,7 +624,12 @@ class Translator:
         return score
 
     @classmethod
-    def find_best_merge_sentence(cls, intervaled, template):
+    def find_best_merge_sentence(cls, intervaled, template, log=print,
+                                 max_combinations=None):
+        """Merge sentences of intervaled so that it looks like template
+
+        Return False, without merging anything, if there are more than
+        max_combinations ways to merge them."""
         number_of_possible_merges = len(intervaled)//2
         merge_positions = range(number_of_possible_merges)
         number_of_merges = number_of_possible_merges - len(template)//2
@@ -566,8 +638,10 @@ class Translator:
         best_score = None
 
         # This is inefficient, but still more than the brain of the user.
-        for combination in itertools.combinations(merge_positions,
-                                                  number_of_merges):
+        for count, combination in enumerate(itertools.combinations(
+                merge_positions, number_of_merges)):
+            if count == max_combinations:
+                return False
             new_intervaled = intervaled[:]
             for merges_done, index_to_merge in enumerate(combination):
                 index = (index_to_merge - merges_done)*2
@@ -581,17 +655,21 @@ class Translator:
                 best_score = score
 
         if best_merge is not None:
-            print("Merge %s -> %s, score: %.2f" % (number_of_possible_merges,
-                                                   len(template)//2,
-                                                   best_score))
+            log("Merge %s -> %s, score: %.2f" % (number_of_possible_merges,
+                                                 len(template)//2,
+                                                 best_score))
             intervaled.clear()
             intervaled.extend(best_merge)
+        return True
 
     @classmethod
-    def split_translation(cls, filtered_lang_label):
+    def split_translation(cls, filtered_lang_label, log=print,
+                          max_combinations=None):
         """Given a lang label, return an array of langlabels for each sentence
 
-        this method contains heuristics, use with care"""
+        this method contains heuristics, use with care.  Messages are passed
+        to log.  Return None if merging sentences of some locale requires
+        more than max_combinations tries, see find_best_merge_sentence()"""
         splitted = {}
         minsize = 99999999
         minsizelocale = None
@@ -616,8 +694,10 @@ class Translator:
         if minsizelocale and minsize != maxsize:
             template = splitted[minsizelocale]
             for locale, split in splitted.items():
-                if len(split) != len(template):
-                    cls.find_best_merge_sentence(split, template)
+                if (len(split) != len(template)
+                        and not cls.find_best_merge_sentence(
+                            split, template, log, max_combinations)):
+                    return None
         elif minsizelocale is None:
             return [filtered_lang_label]
         # splitted is a langlabel of arrays
@@ -656,8 +736,13 @@ class Translator:
     }
 
     def command_split_trans(self, file_dict_path_str, filtered_lang_label,
-                            orig, known):
-        splitted = self.split_translation(filtered_lang_label)
+                            orig, known, prepared_split=None):
+        if prepared_split is None:
+            splitted = self.split_translation(filtered_lang_label)
+        else:
+            splitted, merge_messages = prepared_split
+            for message in merge_messages:
+                print(message)
         known_partial = [] if not known else known.get("partial", [])
         partial = []
         results = []
@@ -717,9 +802,13 @@ class Translator:
     def curry_command_split_trans(self, *args):
         return lambda ignored: self.command_split_trans(*args)
 
-    def ask_for_complete_trans(self, file_dict_path_str,
-                               filtered_lang_label, tags, known, duplicate,
-                               orig):
+    # :split with more ways to merge sentences is only prepared on demand
+    MAX_PREPARED_MERGES = 10000
+
+    def prepare_prompt(self, file_dict_path_str, filtered_lang_label, tags,
+                       known, orig):
+        """Compute what ask_for_complete_trans() needs, except what depends
+        on other entries of the pack.  This may run in another thread."""
         real_known = stale = None
         if known and "text" in known:
             if "orig" in known and orig != known["orig"]:
@@ -731,35 +820,91 @@ class Translator:
             else:
                 real_known = known
 
-        to_show = self.format_trans_to_show(filtered_lang_label, tags,
-                                            real_known, stale, orig,
-                                            file_dict_path_str)
-        self.setup_autocomplete(filtered_lang_label.values())
+        merge_messages = []
+        splitted = self.split_translation(filtered_lang_label,
+                                          merge_messages.append,
+                                          self.MAX_PREPARED_MERGES)
+        return {
+            "known": known,
+            "real_known": real_known,
+            "stale": stale,
+            "to_show": self.format_trans_to_show(filtered_lang_label, tags,
+                                                 real_known, stale, orig,
+                                                 file_dict_path_str),
+            "completions": self.find_completions(
+                filtered_lang_label.values()),
+            "split": None if splitted is None else (splitted, merge_messages)
+        }
+
+    def prepare_prompts(self, iterator):
+        """Yield the items of a walker with their prepare_prompt() appended
+
+        This is meant to run ahead of the prompts, in a
+        common.BackgroundIterator.  The time it takes is accounted in
+        prepare_time."""
+        for file_dict_path_str, lang_label, tags, known in iterator:
+            start = time.perf_counter()
+            prepared = self.prepare_prompt(
+                file_dict_path_str, self.config.prune_langlabel(lang_label),
+                tags, known, lang_label[self.config.from_locale])
+            self.prepare_time += time.perf_counter() - start
+            self.prepare_count += 1
+            yield file_dict_path_str, lang_label, tags, known, prepared
+
+    def ask_for_complete_trans(self, file_dict_path_str,
+                               filtered_lang_label, tags, known, duplicate,
+                               orig, prepared=None):
+        if prepared is None or prepared["known"] is not known:
+            prepared = self.prepare_prompt(file_dict_path_str,
+                                           filtered_lang_label, tags, known,
+                                           orig)
+        real_known = prepared["real_known"]
+        stale = prepared["stale"]
+
+        self.setup_autocomplete(prepared["completions"])
         self.setup_prefilled_text(real_known, stale, duplicate)
 
         commands = dict(self.common_commands)
         commands['split'] = self.curry_command_split_trans(file_dict_path_str,
                                                            filtered_lang_label,
-                                                           orig, known)
+                                                           orig, known,
+                                                           prepared["split"])
 
         if known and "text" not in known and "partial" in known:
             self.command_split_trans(file_dict_path_str, filtered_lang_label,
-                                     orig, known)
+                                     orig, known, prepared["split"])
 
-        string = self.prompt_user(to_show, '> ', commands)
+        string = self.prompt_user(prepared["to_show"], '> ', commands)
         if not string and not self.config.allow_empty:
             return
         trans = CommandParser.parse_line_input(string)
         pack.add_translation(file_dict_path_str, orig, trans)
 
     def ask_for_multiple_translations(self, iterator):
-        for file_dict_path_str, lang_label, tags, known in iterator:
+        """Ask for the translation of items yielded by prepare_prompts()
+
+        The time spent waiting for them is accounted in wait_time."""
+        # the iterator may run ahead (see common.BackgroundIterator) and
+        # the pack may have changed since, e.g. with :e, so ask again.
+        known_filter = self.config.get_trans_known_filter(self.pack)
+        iterator = iter(iterator)
+        while True:
+            start = time.perf_counter()
+            item = next(iterator, None)
+            self.wait_time += time.perf_counter() - start
+            if item is None:
+                return
+            self.wait_count += 1
+            file_dict_path_str, lang_label, tags, _, prepared = item
+            known = known_filter(file_dict_path_str, lang_label)
+            if known is None:
+                continue
             lang_label_to_show = self.config.prune_langlabel(lang_label)
             orig = lang_label[self.config.from_locale]
 
             dup = pack.get_by_orig(orig)
             self.ask_for_complete_trans(file_dict_path_str, lang_label_to_show,
-                                        tags, known, dup, orig)
+                                        tags, known, dup, orig, prepared)
 
 
 def parse_args():
@@ -775,6 +920,8 @@ def parse_args():
                                 without the leading '--' and with '-'
                                 replaced by '_'.  Options given here
                                 override those found in the config file.""")
+    parser.add_argument("--no-daemon", dest="no_daemon", action="store_true",
+                        help="""Do not use a running daemon, see 'daemon'""")
     config.add_options_to_argparser(parser)
 
     subparser = parser.add_subparsers(metavar="COMMAND", required=True)
@@ -923,6 +1070,33 @@ def parse_args():
                        --pack-file, check this directory of assets.  This can
                        be used against the game files or some mods's asset.
                        Not everything can be checked in this mode""")
+    check.add_argument("--jobs", "-j", type=int, default=1,
+                       metavar="<processes>",
+                       help="""Check the pack using this many processes.
+                       Errors are then only shown at the end.""")
+    check.add_argument("--no-cache", dest="check_no_cache",
+                       action="store_true",
+                       help="""Check every entry again, instead of reusing
+                       the errors of unmodified entries stored in
+                       --check-cache-file.  The cache is still updated.""")
+    check.add_argument("--output-format", dest="output_format",
+                       choices=sorted(output_formats), default="human",
+                       help="""Format of errors: 'human' (the default) for
+                       colored text, 'jsonl' for one json object per line
+                       and error, or 'sarif' for a SARIF-like json document.
+                       All of them end with the number of errors of each
+                       severity and kind.""")
+    check.add_argument("--rule-stats", dest="rule_stats", action="store_true",
+                       help="""At the end, show how many texts each badness
+                       and replacement of the configuration matched and how
+                       long it took, slowest first.  Entries whose errors
+                       come from the cache are not counted.""")
+    check.add_argument("--watch", dest="check_watch", action="store_true",
+                       help="""After checking the pack, keep everything
+                       loaded and check it again each time the pack file
+                       changes, only for modified entries and entries
+                       referencing them with \\v.  Stop with ^C.  The
+                       cache is not used in this mode.""")
     check.set_defaults(check=True)
 
     get = subparser.add_parser("get",
@@ -944,6 +1118,16 @@ def parse_args():
                                       """)
     save_cache.set_defaults(save_cache=True)
 
+    daemon = subparser.add_parser("daemon",
+                                  help="""Load the string cache, the pack
+                                  file and the checker once and answer
+                                  requests on the socket specified by
+                                  --daemon-socket, until interrupted.
+                                  'get', 'count' and 'check' use the daemon
+                                  when it runs with the same configuration.
+                                  See the Daemon class for the protocol.""")
+    daemon.set_defaults(daemon=True)
+
 
     result = parser.parse_args()
     if "save_config" in result:
@@ -970,13 +1154,22 @@ def parse_args():
     extra["debug"] = vars(result).get("debug", False)
     extra["do_check"] = "check" in result
     extra["check-asset-path"] = vars(result).get("assetpath")
+    extra["check-jobs"] = vars(result).get("jobs", 1)
+    extra["check-no-cache"] = vars(result).get("check_no_cache", False)
+    extra["check-rule-stats"] = vars(result).get("rule_stats", False)
+    extra["check-output-format"] = vars(result).get("output_format", "human")
+    extra["check-watch"] = vars(result).get("check_watch", False)
     extra["do_cache"] = "save_cache" in result
+    extra["do_daemon"] = "daemon" in result
+    extra["no_daemon"] = result.no_daemon
     return config, extra
 
-def count_or_debug(config, extra, pack):
+def count_or_debug(config, extra, pack, string_cache=None):
     uniques = {}
     count = 0
-    iterator = config.iterate_over_configured_source(pack)
+    # a loaded string cache is reused afterward, so do not drain it.
+    iterator = config.iterate_over_configured_source(
+        pack, string_cache=string_cache, drain=string_cache is None)
     for file_dict_path_str, lang_label, tags, _ in iterator:
         orig = lang_label.get(config.from_locale)
         if orig is None:
@@ -985,6 +1178,8 @@ def count_or_debug(config, extra, pack):
         count += 1
         if extra["debug"]:
             print("%s: %s"%(file_dict_path_str, " ".join(tags)))
+    if extra["debug"]:
+        print("Memory:", config.interner.report())
     print("Total strings:", count)
     print("Unique strings:", len(uniques))
     print("Most duplicated strings:")
@@ -1000,12 +1195,15 @@ def save_into_cache(config, pack):
     iterator = config.iterate_over_all_game()
 
     cache = common.string_cache()
-    for file_dict_path_str, lang_label, tags, _ in iterator:
-        cache.add(file_dict_path_str, lang_label, {"tags": " ".join(tags)})
+    for order, (file_dict_path_str, lang_label, tags, _) in enumerate(iterator):
+        # order allows packfile.py to sort by game order without walking it.
+        cache.add(file_dict_path_str, lang_label, {"tags": " ".join(tags),
+                                                   "order": order})
     cache.save_into_file(config.string_cache_file)
 
-def print_lang_label(config, file_dict_path_str):
-    sparse_reader = config.get_sparse_reader()
+def print_lang_label(config, file_dict_path_str, sparse_reader=None):
+    if sparse_reader is None:
+        sparse_reader = config.get_sparse_reader()
     complete = sparse_reader.get_complete_by_str(file_dict_path_str)
     langlabel, (file_path, dict_path), reverse_path = complete
     if not langlabel:
@@ -1021,13 +1219,342 @@ def print_lang_label(config, file_dict_path_str):
     print(a)
 
 
+class Daemon:
+    """Serve requests over a Unix socket, keeping everything loaded.
+
+    The string cache, the pack and the checker are only loaded once, and
+    the pack is reloaded when its file changes.
+
+    Requests and responses are JSON objects, one per line.  Requests have an
+    "op" and a "config" (see daemon_identity()), responses have the "output"
+    the command would print and its "exit" status, or an "error":
+
+    {"op": "get", "file_dict_path": "..."}
+    {"op": "count", "options": {"filter_tags": [["conv"]], ...}}
+    {"op": "check", "jobs": 1, "cache": "/abs/check-cache.json"} checks the
+    whole pack, optionally with a CheckCache ("reuse_cache": false ignores
+    its content), while
+    {"op": "check", "file_dict_path": "...", "text": "..."} only checks an
+    entry, optionally with another text than the one in the pack.
+    {"op": "lookup", "orig": "..."} finds a translation of an original text,
+    or with "all": true, every translation of it, one per line after its
+    file_dict_path and a tab.
+    """
+    # options of count requests that override the daemon's configuration
+    count_options = ("filter_file_path", "filter_dict_path", "filter_quality",
+                     "filter_tags", "filter_orig", "ignore_known",
+                     "ignore_unknown")
+
+    def __init__(self, config, extra):
+        self.config = config
+        self.identity = daemon_identity(config, extra)
+        self.sparse_reader = config.get_sparse_reader()
+        self.string_cache = None
+        if isinstance(self.sparse_reader, common.string_cache):
+            self.string_cache = self.sparse_reader
+        self.checker = PackChecker(self.sparse_reader, extra.get("check", {}))
+        self.pack = PackFile()
+        self.pack_mtime = None
+        self.reload_pack_if_modified()
+        print("Memory:", config.interner.report())
+
+    def reload_pack_if_modified(self):
+        try:
+            mtime = os.stat(self.config.packfile).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.pack_mtime:
+            return
+        self.pack_mtime = mtime
+        self.pack = PackFile()
+        if mtime is not None:
+            # keep the shared interner from growing with each reload.
+            self.pack.load(self.config.packfile,
+                           interner=common.StringInterner(
+                               self.config.interner))
+
+    def op_get(self, request):
+        print_lang_label(self.config, request["file_dict_path"],
+                         self.sparse_reader)
+
+    def op_count(self, request):
+        config = copy.copy(self.config)
+        for key, value in request.get("options", {}).items():
+            if key not in self.count_options:
+                raise ValueError("Unknown count option: %s" % key)
+            setattr(config, key, value)
+        config.check()
+        count_or_debug(config, {"debug": request.get("debug", False)},
+                       self.pack, self.string_cache)
+
+    def op_check(self, request):
+        self.checker.errors = 0
+        output_format = request.get("output_format", "human")
+        if output_format not in output_formats:
+            raise ValueError("Unknown output format: %s" % output_format)
+        self.checker.output = output_formats[output_format]()
+        file_dict_path_str = request.get("file_dict_path")
+        if file_dict_path_str is None:
+            cache = None
+            if request.get("cache"):
+                cache = CheckCache(request["cache"],
+                                   self.checker.cache_settings(),
+                                   request.get("reuse_cache", True))
+            rule_stats = request.get("rule_stats", False)
+            self.checker.set_rule_timing(rule_stats)
+            try:
+                self.checker.check_pack(self.pack, request.get("jobs", 1),
+                                        cache)
+            finally:
+                self.checker.set_rule_timing(False)
+                stats = self.checker.get_rule_stats(reset=True)
+            self.checker.output.finish()
+            if rule_stats:
+                self.checker.print_rule_stats(stats)
+        else:
+            trans = self.pack.get(file_dict_path_str)
+            if "text" in request:
+                trans = dict(trans or {}, text=request["text"])
+            if trans is None:
+                print("Not found")
+                return 1
+            self.checker.check_entry(file_dict_path_str, trans,
+                                     self.checker.make_get_text(self.pack))
+            self.checker.output.finish()
+        return 1 if self.checker.errors else 0
+
+    def op_lookup(self, request):
+        if request.get("all"):
+            translations = self.pack.get_all_by_orig(request["orig"])
+            for file_dict_path_str, trans in translations.items():
+                print("%s\t%s" % (file_dict_path_str,
+                                  CommandParser.make_line_input(trans)))
+            if translations:
+                return
+        else:
+            trans = self.pack.get_by_orig(request["orig"])
+            if trans is not None:
+                print(CommandParser.make_line_input(trans))
+                return
+        print("Not found")
+        return 1
+
+    def handle(self, request):
+        """Handle a request and return the response"""
+        if not isinstance(request, dict):
+            return {"error": "requests must be JSON objects"}
+        handler = getattr(self, "op_%s" % request.get("op"), None)
+        if handler is None:
+            return {"error": "unknown operation: %s" % request.get("op")}
+        if request.get("config") != self.identity:
+            return {"error": "the daemon uses another configuration"}
+
+        self.reload_pack_if_modified()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                status = handler(request) or 0
+            except SystemExit as exc:
+                status = exc.code if isinstance(exc.code, int) else 1
+            except Exception as exc:
+                return {"error": "%s: %s" % (exc.__class__.__name__, exc)}
+        return {"output": output.getvalue(), "exit": status}
+
+    def serve(self):
+        path = self.config.daemon_socket
+        if not path:
+            print("no daemon socket specified")
+            sys.exit(1)
+        if os.path.exists(path):
+            if ask_daemon(path, None) is not None:
+                print("a daemon is already listening on", path)
+                sys.exit(1)
+            # stale socket of a daemon that did not exit cleanly
+            os.unlink(path)
+
+        # remove the socket when killed, too
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        print("listening on", path)
+        try:
+            while True:
+                connection, _ = server.accept()
+                # do not let a stuck client block everyone else
+                connection.settimeout(60)
+                try:
+                    with connection, connection.makefile(
+                            "rw", encoding="utf-8") as stream:
+                        for line in stream:
+                            if not line.strip():
+                                continue
+                            try:
+                                request = json.loads(line)
+                            except ValueError as exc:
+                                response = {"error": "invalid JSON: %s" % exc}
+                            else:
+                                response = self.handle(request)
+                            stream.write(json.dumps(response) + "\n")
+                            stream.flush()
+                except OSError as exc:
+                    print("connection error:", exc)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.unlink(path)
+
+
+def daemon_identity(config, extra):
+    """Settings that must be the same for the daemon and its clients"""
+    return {"packfile": os.path.abspath(config.packfile),
+            "string_cache_file": os.path.abspath(config.string_cache_file),
+            "gamedir": os.path.abspath(config.gamedir),
+            "from_locale": config.from_locale,
+            "locales_to_show": config.locales_to_show,
+            "check": extra.get("check", {})}
+
+
+def ask_daemon(path, request):
+    """Send a request to the daemon listening on path and return its response
+
+    Return None if no daemon is running.  If request is None, only check if
+    a daemon is listening, returning {} if it is."""
+    if not path or not hasattr(socket, "AF_UNIX"):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+    except OSError:
+        connection.close()
+        return None
+    with connection, connection.makefile("rw", encoding="utf-8") as stream:
+        if request is None:
+            return {}
+        stream.write(json.dumps(request) + "\n")
+        stream.flush()
+        line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def forward_to_daemon(config, extra):
+    """If a daemon is running, let it handle get, count and check commands.
+
+    Exit with the daemon's status if it handled the command, otherwise
+    return so that the command runs locally."""
+    if extra["do_get"]:
+        request = {"op": "get", "file_dict_path": extra["do_get"]}
+    elif extra["do_count"]:
+        options = {key: getattr(config, key) for key in Daemon.count_options}
+        request = {"op": "count", "debug": extra["debug"], "options": options}
+    elif (extra["do_check"] and not extra["check-asset-path"]
+          and not extra["check-watch"]):
+        cache_path = None
+        if config.check_cache_file:
+            cache_path = os.path.abspath(config.check_cache_file)
+        request = {"op": "check", "jobs": extra["check-jobs"],
+                   "cache": cache_path,
+                   "reuse_cache": not extra["check-no-cache"],
+                   "rule_stats": extra["check-rule-stats"],
+                   "output_format": extra["check-output-format"]}
+    else:
+        return
+    request["config"] = daemon_identity(config, extra)
+    response = ask_daemon(config.daemon_socket, request)
+    if response is None:
+        return
+    if "error" in response:
+        print("not using the daemon:", response["error"], file=sys.stderr)
+        return
+    print(response["output"], end="")
+    sys.exit(response["exit"])
+
+
+def watch_pack(config, checker, pack, jobs=1, interval=0.25):
+    """Check the pack, then check it again each time its file changes.
+
+    Only entries that were added or modified, and entries whose \\v
+    references resolve to them, are checked again.  Runs until ^C."""
+    translations = pack.get_all()
+    errors = {}
+    references = {}
+
+    def check_and_print(paths):
+        checked = checker.check_entries(pack, paths, jobs)
+        for file_dict_path_str, entry_errors, entry_references in checked:
+            errors[file_dict_path_str] = sum(
+                1 for record in entry_errors if record[1] == "error")
+            references[file_dict_path_str] = entry_references
+            for record in entry_errors:
+                checker.print_error(*record)
+        checker.output.finish()
+
+    def stat_pack():
+        try:
+            return os.stat(config.packfile).st_mtime_ns
+        except OSError:
+            return None
+
+    last_mtime = stat_pack()
+    check_and_print(list(translations))
+    print("watching %s, press ^C to stop" % config.packfile)
+    try:
+        while True:
+            time.sleep(interval)
+            mtime = stat_pack()
+            if mtime is None or mtime == last_mtime:
+                continue
+            last_mtime = mtime
+            start = time.perf_counter()
+            # the base class does not print statistics on each load.
+            new_pack = common.PackFile()
+            try:
+                new_pack.load(config.packfile,
+                              interner=common.StringInterner(config.interner))
+            except (OSError, ValueError) as exc:
+                print("cannot load %s: %s" % (config.packfile, exc))
+                continue
+            new_translations = new_pack.get_all()
+            changed = checker.find_changes(translations, new_translations)
+            to_check = changed | checker.find_dependents(references, changed)
+            for file_dict_path_str in changed - new_translations.keys():
+                errors.pop(file_dict_path_str, None)
+                references.pop(file_dict_path_str, None)
+            pack, translations = new_pack, new_translations
+            to_check = [file_dict_path_str
+                        for file_dict_path_str in translations
+                        if file_dict_path_str in to_check]
+            print("%s changed: checking %i entries (%i modified)"
+                  % (config.packfile, len(to_check), len(changed)))
+            checker.errors = 0
+            check_and_print(to_check)
+            print("checked in %.3fs, %i errors in the whole pack"
+                  % (time.perf_counter() - start, sum(errors.values())))
+    except KeyboardInterrupt:
+        pass
+
+
 if __name__ == '__main__':
     config, extra = parse_args()
 
+    if extra["do_daemon"]:
+        Daemon(config, extra).serve()
+        sys.exit(0)
+    if not extra["no_daemon"]:
+        forward_to_daemon(config, extra)
+
     if extra["do_get"]:
         print_lang_label(config, extra["do_get"])
         sys.exit(0)
 
+    output_stream = sys.stdout
+    if extra["do_check"] and extra["check-output-format"] != "human":
+        # leave only diagnostics on stdout, for programs reading them.
+        sys.stdout = sys.stderr
+
     pack = PackFile()
     readliner = Readliner()
     if os.path.exists(config.packfile) and not extra["check-asset-path"]:
@@ -1037,7 +1564,7 @@ if __name__ == '__main__':
         else:
             add_to_history = lambda x: None
 
-        pack.load(config.packfile, add_to_history)
+        pack.load(config.packfile, add_to_history, config.interner)
         for entry in history:
             readliner.add_history(CommandParser.make_line_input(entry))
         del history
@@ -1045,13 +1572,28 @@ if __name__ == '__main__':
         count_or_debug(config, extra, pack)
     if extra["do_check"]:
         check_options = extra.get("check", {})
+        output = output_formats[extra["check-output-format"]](output_stream)
         if extra["check-asset-path"]:
             checker = check_assets(config.get_sparse_reader(), check_options,
                                    extra["check-asset-path"],
-                                   config.from_locale)
+                                   config.from_locale, output)
+            output.finish()
         else:
             checker = PackChecker(config.get_sparse_reader(), check_options)
-            checker.check_pack(pack)
+            checker.output = output
+            checker.set_rule_timing(extra["check-rule-stats"])
+            if extra["check-watch"]:
+                watch_pack(config, checker, pack, extra["check-jobs"])
+                sys.exit(0)
+            cache = None
+            if config.check_cache_file:
+                cache = CheckCache(config.check_cache_file,
+                                   checker.cache_settings(),
+                                   not extra["check-no-cache"])
+            checker.check_pack(pack, extra["check-jobs"], cache)
+            output.finish()
+            if extra["check-rule-stats"]:
+                checker.print_rule_stats(checker.get_rule_stats())
         sys.exit(1 if checker.errors else 0)
     if extra["do_cache"]:
         save_into_cache(config, pack)
@@ -1060,20 +1602,26 @@ if __name__ == '__main__':
     readliner.set_compose_map(config.compose_chars)
     translator = Translator(config, pack, readliner)
 
-    import signal
     if hasattr(signal, "SIGINT"):
         def sigint_once(sigint, frame):
             signal.signal(signal.SIGINT, signal.SIG_IGN)
             original_sigint_handler(sigint, frame)
         original_sigint_handler = signal.signal(signal.SIGINT, sigint_once)
 
+    # find, filter and prepare strings while the translator reads the first
+    # ones.
+    iterator = common.BackgroundIterator(
+        translator.prepare_prompts(
+            config.iterate_over_configured_source(pack, stream=True)),
+        max(1, config.lookahead))
     try:
         try:
-            iterator = config.iterate_over_configured_source(pack)
             translator.ask_for_multiple_translations(iterator)
         except EOFError:
             pass
         except KeyboardInterrupt:
             pass
     finally:
+        iterator.close()
         pack.save(config.packfile)
+        print(translator.get_prepare_stats())
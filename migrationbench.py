@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+
+"""Benchmark the accuracy and speed of packfile.py's calcmigration.
+
+Given a string cache, this creates a fake new version of the game by applying
+controlled mutations to it (moving strings, renaming files, editing texts...),
+then run the migration algorithm and compare its result with the known
+mapping.  Run --help for details."""
+
+import time
+import random
+import tracemalloc
+import contextlib
+import io
+import itertools
+import common
+from packfile import MigrationCalculator
+
+
+MUTATIONS = ("move_within_file", "move_across_files", "rename_file",
+             "edit_text", "delete", "insert")
+
+
+class Mutator:
+    """Create a mutated copy of a string cache along with the ground truth"""
+    def __init__(self, entries, from_locale, rates, seed):
+        # dict from file_dict_path_str to string cache entries
+        self.entries = entries
+        self.from_locale = from_locale
+        self.rates = rates
+        self.rng = random.Random(seed)
+
+    @staticmethod
+    def copy_entry(entry):
+        ret = dict(entry)
+        ret["langlabel"] = dict(entry["langlabel"])
+        return ret
+
+    def edit_text(self, text):
+        """Return text with a small typo-like modification"""
+        if not text:
+            return "x"
+        index = self.rng.randrange(len(text))
+        operation = self.rng.randrange(3)
+        if operation == 0:
+            return text[:index] + text[index+1:]
+        new_char = self.rng.choice("abcdefghijklmnopqrstuvwxyz ")
+        if operation == 1:
+            return text[:index] + new_char + text[index:]
+        return text[:index] + new_char + text[index+1:]
+
+    def mutate(self):
+        """Return (destination entries, truth, kinds)
+
+        truth is a dict from source file_dict_path_str to destination
+        file_dict_path_str, or None if the string was deleted.
+        kinds is a dict from source file_dict_path_str to the name of the
+        applied mutation, or None if unmodified."""
+        rng = self.rng
+        files = {}
+        for file_dict_path_str in self.entries:
+            file_str = common.split_file_dict_path(file_dict_path_str)[0]
+            files.setdefault(file_str, []).append(file_dict_path_str)
+        file_list = list(files)
+
+        renamed = {}
+        for file_str in file_list:
+            if rng.random() < self.rates["rename_file"]:
+                renamed[file_str] = "%s-renamed.json" % file_str[:-5]
+
+        dest = {}
+        truth = {}
+        kinds = {}
+        for file_dict_path_str, entry in self.entries.items():
+            file_str, dict_path_str = common.split_file_dict_path(
+                file_dict_path_str)
+            entry = self.copy_entry(entry)
+            kind = None
+            new_path = file_dict_path_str
+            if file_str in renamed:
+                kind = "rename_file"
+                new_path = "%s/%s" % (renamed[file_str], dict_path_str)
+            else:
+                roll = rng.random()
+                for mutation in MUTATIONS[:-1]:
+                    if mutation == "rename_file":
+                        continue
+                    if roll < self.rates[mutation]:
+                        kind = mutation
+                        break
+                    roll -= self.rates[mutation]
+
+            if kind == "delete":
+                truth[file_dict_path_str] = None
+                kinds[file_dict_path_str] = kind
+                continue
+            if kind == "move_within_file":
+                new_path = "%s/%s-moved" % (file_str, dict_path_str)
+            elif kind == "move_across_files":
+                other_file = rng.choice(file_list)
+                new_path = "%s/%s-moved" % (renamed.get(other_file,
+                                                        other_file),
+                                            dict_path_str)
+            elif kind == "edit_text":
+                text = entry["langlabel"].get(self.from_locale)
+                if isinstance(text, str):
+                    entry["langlabel"][self.from_locale] = self.edit_text(text)
+
+            if new_path in dest:
+                # collision with another moved string, keep it simple.
+                new_path = "%s-%d" % (new_path, len(dest))
+            dest[new_path] = entry
+            truth[file_dict_path_str] = new_path
+            kinds[file_dict_path_str] = kind
+
+        for index in range(int(len(self.entries) * self.rates["insert"])):
+            file_str = renamed.get(rng.choice(file_list))
+            if file_str is None:
+                file_str = rng.choice(file_list)
+            text = "inserted text number %d %x" % (index, rng.getrandbits(32))
+            dest["%s/inserted/%d" % (file_str, index)] = {
+                "langlabel": {self.from_locale: text}, "tags": ""}
+        return dest, truth, kinds
+
+
+def make_string_cache(entries):
+    ret = common.string_cache()
+    ret.data = dict(entries)
+    return ret
+
+
+def run_migration(src_entries, dest_entries, args):
+    """Run the migration algorithm, return the migration map"""
+    migrator = MigrationCalculator(make_string_cache(src_entries),
+                                   make_string_cache(dest_entries))
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        migrator.do_everything(args.no_file_move,
+                               args.from_locale if args.fuzzy else None)
+    if args.verbose:
+        print(output.getvalue(), end="")
+    return migrator.map
+
+
+def evaluate(migration_map, truth, kinds):
+    """Return precision, recall, and recall per mutation kind"""
+    correct = predicted = expected = 0
+    per_kind = {}
+    for src, expected_dest in truth.items():
+        if src in migration_map:
+            predicted_dest = migration_map[src]
+            if predicted_dest is None:
+                predicted_dest = src
+            predicted += 1
+        else:
+            predicted_dest = None
+
+        kind_stat = per_kind.setdefault(kinds[src], [0, 0])
+        if expected_dest is None:
+            # deleted strings are correctly handled if not matched.
+            kind_stat[1] += 1
+            kind_stat[0] += predicted_dest is None
+            continue
+        expected += 1
+        kind_stat[1] += 1
+        if predicted_dest == expected_dest:
+            correct += 1
+            kind_stat[0] += 1
+
+    precision = correct / predicted if predicted else 1.
+    recall = correct / expected if expected else 1.
+    per_kind = {kind: found / total for kind, (found, total)
+                in per_kind.items()}
+    return precision, recall, per_kind
+
+
+def do_benchmark(args):
+    cache = common.load_json(args.string_cache)
+    rates = {mutation: getattr(args, mutation) for mutation in MUTATIONS}
+    sizes = args.sizes or [len(cache)]
+
+    print("%8s %10s %10s %10s %10s" % ("size", "time (s)", "peak (MiB)",
+                                       "precision", "recall"))
+    for size in sizes:
+        src_entries = dict(itertools.islice(cache.items(), size))
+        mutator = Mutator(src_entries, args.from_locale, rates, args.seed)
+        dest_entries, truth, kinds = mutator.mutate()
+
+        start = time.perf_counter()
+        migration_map = run_migration(src_entries, dest_entries, args)
+        elapsed = time.perf_counter() - start
+
+        peak = float("nan")
+        if not args.no_memory:
+            tracemalloc.start()
+            run_migration(src_entries, dest_entries, args)
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+
+        precision, recall, per_kind = evaluate(migration_map, truth, kinds)
+        print("%8d %10.3f %10.1f %10.4f %10.4f" % (len(src_entries), elapsed,
+                                                   peak, precision, recall))
+        for kind in (None,) + MUTATIONS:
+            if kind in per_kind:
+                print("%30s: %.4f" % (kind or "unmodified", per_kind[kind]))
+
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser(description="""Benchmark the migration
+                                     algorithm of packfile.py calcmigration
+                                     by migrating a string cache to a
+                                     mutated copy of itself""")
+    parser.add_argument("string_cache", metavar="<string cache>",
+                        help="""string cache to use as the old version""")
+    parser.add_argument("--sizes", nargs="+", type=int, metavar="<size>",
+                        help="""Run the benchmark with the first <size>
+                        strings of the cache, for each given size.  The
+                        default is to use the entire cache.""")
+    parser.add_argument("--from-locale", "-l", metavar="locale",
+                        default="en_US", dest="from_locale",
+                        help="""Locale of the texts to modify and to match
+                        with --fuzzy. Defaults to en_US""")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="""Seed of the random mutations""")
+    parser.add_argument("--no-file-move", dest="no_file_move",
+                        action="store_true",
+                        help="""Same as calcmigration's --no-file-move""")
+    parser.add_argument("--fuzzy", action="store_true",
+                        help="""Same as calcmigration's --fuzzy""")
+    parser.add_argument("--no-memory", dest="no_memory", action="store_true",
+                        help="""Do not measure peak memory usage.  Measuring
+                        it requires running the algorithm a second time.""")
+    parser.add_argument("--verbose", "-v", action="store_true",
+                        help="""Show the migration statistics""")
+    defaults = {"move_within_file": 0.02, "move_across_files": 0.01,
+                "rename_file": 0.02, "edit_text": 0.03, "delete": 0.01,
+                "insert": 0.01}
+    for mutation in MUTATIONS:
+        parser.add_argument("--%s" % mutation.replace("_", "-"),
+                            dest=mutation, type=float, metavar="<rate>",
+                            default=defaults[mutation],
+                            help="""Ratio of strings (or files) to %s.
+                            Defaults to %s""" % (mutation.replace("_", " "),
+                                                 defaults[mutation]))
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    do_benchmark(parse_args())
@@ -5,84 +5,94 @@
 import re
 import os
 import sys
+import json
+import zlib
+import hashlib
 import types
+import random
 import functools
 import common
 
 
-def sort_by_game(game_walker, from_locale, pack):
-    """Sort a pack by the order in which strings appears in the game files.
-
-    This is one of the slowest sorting method.  If the pack contains strings
-    that are not present in the game, they are sorted alphabetically at the
-    end and a message is logged."""
-
-    def get_file_path_tuple(file_dict_path_str):
-        return tuple(common.unserialize_dict_path(file_dict_path_str)[0])
-
-    def get_packs_by_file(pack):
-        """Return a dict from file_path_tuple to a pack for that file path"""
-        packs_by_file = {}
-        for file_dict_path_str, result in pack.items():
-            file_path_tuple = get_file_path_tuple(file_dict_path_str)
-            pack = packs_by_file.setdefault(file_path_tuple, {})
-            pack[file_dict_path_str] = result
-        return packs_by_file
-
-    packs_by_file = get_packs_by_file(pack)
-
-    known_files = frozenset(packs_by_file.keys())
-    game_walker.set_file_path_filter(lambda f_p: tuple(f_p) in known_files)
-
-    def iterate_game_and_pick_translations(packs_by_file, game_walker):
-        """Iterate with game_walker and drain packs_by_file
-
-        Return a sorted single pack with elements in the same order as
-        returned by game_walker with translations from packs_by_file.
-
-        This will drain packs_by_file in the process, so only stale strings
-        will remain there."""
-
-        output = {}
-        iterator = game_walker.walk(from_locale, False)
-
-        current_file = None
-        strings_for_file = None
+class GameOrder:
+    """Sort keys that follow the order in which strings appear in the game.
 
-        def add_stale_for_current_file():
-            """Add strings remaining in strings_for_file to stale translations
+    If the game walker uses a string cache, then the order is read from the
+    ordinals stored in the cache by jsontr.py save_cache (or from the order
+    of the cache for older caches).  Otherwise, the game is walked once,
+    when creating this object.
 
-            Called after iterating for all strings in one game file."""
-            if strings_for_file:
-                print("note: sorting", len(strings_for_file),
-                      "stale nonexisting strings for", "/".join(current_file))
-                output.update(common.sort_dict(strings_for_file))
-                strings_for_file.clear()
+    Objects of this class can be used directly as sort keys, see key()."""
+    def __init__(self, game_walker, from_locale):
+        # file_str => [first ordinal, last ordinal] of strings in that file
+        self.file_ranges = {}
+        # file_dict_path_str => (first ordinal of its file, its ordinal)
+        self.string_order = {}
+        if game_walker.string_cache is not None:
+            iterator = game_walker.string_cache.iterate_order()
+        else:
+            iterator = game_walker.walk(from_locale, False)
+            iterator = ((file_dict_path_str, ordinal) for ordinal,
+                        (file_dict_path_str, _, _, _) in enumerate(iterator))
 
-        for file_dict_path_str, _, _, _ in iterator:
-            file_path = get_file_path_tuple(file_dict_path_str)
-            if current_file != file_path:
-                add_stale_for_current_file()
-                current_file = file_path
-                strings_for_file = packs_by_file.pop(file_path, {})
+        for file_dict_path_str, ordinal in iterator:
+            file_str = common.split_file_dict_path(file_dict_path_str)[0]
+            file_range = self.file_ranges.get(file_str)
+            if file_range is None:
+                file_range = self.file_ranges[file_str] = [ordinal, ordinal]
+            else:
+                file_range[1] = max(file_range[1], ordinal)
+            self.string_order[file_dict_path_str] = (file_range[0], ordinal)
+
+    def key(self, file_dict_path_str):
+        """Return a sort key for the given file_dict_path_str
+
+        Stale strings are sorted alphabetically after the strings of their
+        file, and strings of unknown files are sorted alphabetically by file
+        and dict path after everything else."""
+        known = self.string_order.get(file_dict_path_str)
+        if known is not None:
+            return (0, known[0], 0, known[1], "")
+        file_str = common.split_file_dict_path(file_dict_path_str)[0]
+        file_range = self.file_ranges.get(file_str)
+        if file_range is not None:
+            return (0, file_range[0], 1, 0, file_dict_path_str)
+        file_path = tuple(common.unserialize_dict_path(file_dict_path_str)[0])
+        return (1, file_path, 1, 0, file_dict_path_str)
+
+    __call__ = key
+
+    def log_stale(self, pack):
+        """Log how many strings of the pack are not present in the game"""
+        stale_by_file = {}
+        for file_dict_path_str in pack:
+            if file_dict_path_str in self.string_order:
+                continue
+            file_str = common.split_file_dict_path(file_dict_path_str)[0]
+            stale_by_file[file_str] = stale_by_file.get(file_str, 0) + 1
 
-            result = strings_for_file.pop(file_dict_path_str, None)
-            if result is not None:
-                output[file_dict_path_str] = result
+        for file_str, count in stale_by_file.items():
+            if file_str in self.file_ranges:
+                print("note: sorting", count,
+                      "stale nonexisting strings for", file_str)
+            else:
+                print("note: sorting", count, "strings for nonexisting",
+                      file_str)
 
-        # sort remains of the last file
-        add_stale_for_current_file()
-        return output
+    def sort(self, pack):
+        """Return a copy of pack sorted by game order"""
+        self.log_stale(pack)
+        return dict(sorted(pack.items(), key=lambda i: self.key(i[0])))
 
-    output = iterate_game_and_pick_translations(packs_by_file, game_walker)
 
-    # sort the remaining stales file_path, and add them
-    for file_path, stale_pack in common.sort_dict(packs_by_file).items():
-        print("note: sorting", len(stale_pack), "strings for nonexisting",
-              "/".join(file_path))
-        output.update(common.sort_dict(stale_pack))
+def sort_by_game(game_walker, from_locale, pack):
+    """Sort a pack by the order in which strings appears in the game files.
 
-    return output
+    If the pack contains strings that are not present in the game, they are
+    sorted alphabetically at the end of their file (or at the end for
+    unknown files) and a message is logged.  When sorting several packs,
+    create a GameOrder once and use its sort() method instead."""
+    return GameOrder(game_walker, from_locale).sort(pack)
 
 
 def get_walker(args):
@@ -110,15 +120,71 @@ def get_sorter(args):
     if args.sort_order == "alpha":
         return functools.partial(sort_entries, common.sort_dict)
     if args.sort_order == "game":
-        walker = get_walker(args)
-        from_locale = args.from_locale
-        game_sorter = functools.partial(sort_by_game, walker, from_locale)
-        return functools.partial(sort_entries, game_sorter)
+        game_order = GameOrder(get_walker(args), args.from_locale)
+        return functools.partial(sort_entries, game_order.sort)
 
     raise ValueError("Invalid sort order %s (allowed: none, alpha, game)"
                      % repr(args.sort_order))
 
 
+def alpha_order_key(file_dict_path_str):
+    """Sort key for alphabetical order"""
+    return file_dict_path_str
+
+
+def sort_pack(pack, sort_key, log_stale=True):
+    """Sort a pack and the fields of its entries.
+
+    sort_key is a function that takes a file_dict_path_str, as returned by
+    get_sort_key().  If it is None, return the pack unchanged.  If
+    log_stale is false, strings missing from the game are not logged."""
+    if sort_key is None:
+        return pack
+    if log_stale and isinstance(sort_key, GameOrder):
+        sort_key.log_stale(pack)
+    ret = {}
+    for file_dict_path_str, entry in sorted(pack.items(),
+                                            key=lambda i: sort_key(i[0])):
+        ret[file_dict_path_str] = common.sort_pack_entry(entry)
+    return ret
+
+
+def get_sort_key(args):
+    """Return a function giving sort keys of file_dict_path_str.
+
+    This follows the same order as get_sorter(), but return None if the
+    sort order is "none"."""
+    if args.sort_order == "none":
+        return None
+    if args.sort_order == "alpha":
+        return alpha_order_key
+    if args.sort_order == "game":
+        return GameOrder(get_walker(args), args.from_locale)
+
+    raise ValueError("Invalid sort order %s (allowed: none, alpha, game)"
+                     % repr(args.sort_order))
+
+
+def prefetch_map(function, iterable, jobs):
+    """Like map(), but run function in a pool of jobs threads.
+
+    Results are yielded in order.  At most 2*jobs results are computed in
+    advance."""
+    if jobs <= 1:
+        yield from map(function, iterable)
+        return
+    import collections
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 def get_sparse_reader(args):
     """Return a configured sparse reader given argparse parameters.
 
@@ -147,17 +213,33 @@ def do_make_mapfile(args):
     common.save_json(args.mapfile, result)
 
 
-def do_split(args):
-    """Split a large packfile to multiple ones according to a mapfile"""
-    sorter = get_sorter(args)
+# Sort key used by split worker processes, see init_split_worker()
+split_worker_sort_key = None
 
-    big_pack = common.load_json(args.bigpack)
-    map_file = common.load_json(args.mapfile)
+
+def init_split_worker(sort_key):
+    """Initialize a split worker process, sharing one sort key function"""
+    global split_worker_sort_key
+    split_worker_sort_key = sort_key
+
+
+def write_split_pack(path, pack):
+    """Sort and write a pack, to be run in a split worker process"""
+    common.save_json(path, sort_pack(pack, split_worker_sort_key))
+
+
+def bucket_split_pack(entries, map_file, strip, outputpath):
+    """Distribute pack entries into smaller packs according to a map file.
+
+    entries is an iterable of (file_dict_path_str, entry).  Return a list of
+    (output path, smaller pack) and create the needed directories.  If the
+    map file misses a reference or strip is too large, abort before writing
+    anything."""
     unused_map_files = set(map_file.keys())
     results = {}
     missings = {}
     error = False
-    for file_dict_path_str, trans in big_pack.items():
+    for file_dict_path_str, trans in entries:
         file_path, _ = common.unserialize_dict_path(file_dict_path_str)
         file_path_str = "/".join(file_path)
         to_file_str = map_file.get(file_path_str)
@@ -177,66 +259,345 @@ def do_split(args):
         print("Aborting...")
         sys.exit(1)
 
+    # A bucket is only complete at the end of the big pack, and nothing must
+    # be written if something is missing, so only write now.
+    to_write = []
     for to_file_str, smaller_pack in results.items():
-        to_file = to_file_str.split('/')[args.strip:]
+        to_file = to_file_str.split('/')[strip:]
         if not to_file:
-            print("strip parameter", args.strip, "is too large for path",
+            print("strip parameter", strip, "is too large for path",
                   to_file_str)
             print("Aborting...")
             sys.exit(1)
 
-        actual_dir = os.path.join(args.outputpath, os.sep.join(to_file[:-1]))
+        actual_dir = os.path.join(outputpath, os.sep.join(to_file[:-1]))
         os.makedirs(actual_dir, exist_ok=True)
-        smaller_pack = sorter(smaller_pack)
-        common.save_json(os.path.join(actual_dir, to_file[-1]), smaller_pack)
+        to_write.append((os.path.join(actual_dir, to_file[-1]), smaller_pack))
+    results.clear()
 
     if unused_map_files:
         print(len(unused_map_files),
               "keys where not used in the map file, e.g.:",
               "\n".join(f for i,f in zip(range(10), unused_map_files)))
+    return to_write
+
+
+def write_split_packs(to_write, sort_key, jobs):
+    """Sort and write the result of bucket_split_pack() using jobs processes"""
+    init_split_worker(sort_key)
+    try:
+        import multiprocessing
+        # workers inherits the sort key instead of unpickling it
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        jobs = 1
+    if jobs <= 1:
+        for path, smaller_pack in to_write:
+            write_split_pack(path, smaller_pack)
+        return
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(
+            jobs, mp_context=context, initializer=init_split_worker,
+            initargs=(sort_key,)) as executor:
+        futures = [executor.submit(write_split_pack, path, smaller_pack)
+                   for path, smaller_pack in to_write]
+        for future in futures:
+            future.result()
+
+
+def do_split(args):
+    """Split a large packfile to multiple ones according to a mapfile"""
+    sort_key = get_sort_key(args)
+    map_file = common.load_json(args.mapfile)
+    to_write = bucket_split_pack(common.iterate_json_object(args.bigpack),
+                                 map_file, args.strip, args.outputpath)
+    write_split_packs(to_write, sort_key, args.jobs)
+
+
+class UnsortedPackError(ValueError):
+    """Raised when a pack is not sorted as expected"""
+
+
+def iterate_packs(paths, jobs):
+    """Yield (input index, file_dict_path_str, value) of all entries of packs
+
+    If jobs is more than one, then entire files are read in a thread pool
+    instead of being streamed."""
+    if jobs > 1:
+        packs = prefetch_map(common.load_json, paths, jobs)
+        for index, pack in enumerate(packs):
+            for file_dict_path_str, value in pack.items():
+                yield index, file_dict_path_str, value
+        return
+    for index, path in enumerate(paths):
+        for file_dict_path_str, value in common.iterate_json_object(path):
+            yield index, file_dict_path_str, value
+
+
+def merge_sorted_packs(paths, sort_key, jobs):
+    """Merge packs that are already sorted by sort_key.
+
+    Yield (input index, file_dict_path_str, value), sorted by sort_key.
+    Raise UnsortedPackError if an input is not sorted."""
+    import heapq
+
+    def iterate_sorted(index, entries):
+        previous = None
+        for sequence, (file_dict_path_str, value) in enumerate(entries):
+            key = sort_key(file_dict_path_str)
+            if previous is not None and key < previous:
+                raise UnsortedPackError("%s is not sorted (at %s)" % (
+                    paths[index], file_dict_path_str))
+            previous = key
+            # index and sequence are unique, so values are never compared.
+            yield key, index, sequence, file_dict_path_str, value
+
+    if jobs > 1:
+        packs = prefetch_map(common.load_json, paths, jobs)
+        inputs = [iterate_sorted(index, pack.items())
+                  for index, pack in enumerate(packs)]
+    else:
+        inputs = [iterate_sorted(index, common.iterate_json_object(path))
+                  for index, path in enumerate(paths)]
+    for _, index, _, file_dict_path_str, value in heapq.merge(*inputs):
+        yield index, file_dict_path_str, value
+
+
+def merge_packs_in_memory(paths, sort_key, jobs):
+    """Same as merge_sorted_packs(), but inputs may be unsorted"""
+    entries = list(iterate_packs(paths, jobs))
+    if sort_key is not None:
+        # sort is stable, so the first input wins with duplicates.
+        entries.sort(key=lambda entry: sort_key(entry[1]))
+    return entries
+
+
+def drop_duplicates(entries, on_conflict, sorted_entries):
+    """Yield (file_dict_path_str, value) of entries, without duplicates.
+
+    on_conflict(file_dict_path_str) is called if duplicates have different
+    values, in which case the first one is kept.  If sorted_entries is true,
+    duplicates are assumed to be adjacent, and only the previous entry is
+    kept in memory.  Otherwise, a digest of every value is kept, so memory
+    grows with the number of entries."""
+    previous_path = previous_value = None
+    fingerprints = {}
+    for _, file_dict_path_str, value in entries:
+        if sorted_entries:
+            if file_dict_path_str == previous_path:
+                if value != previous_value:
+                    on_conflict(file_dict_path_str)
+                continue
+            previous_path, previous_value = file_dict_path_str, value
+        else:
+            fingerprint = hashlib.blake2b(
+                json.dumps(value, sort_keys=True).encode(),
+                digest_size=16).digest()
+            if file_dict_path_str in fingerprints:
+                if fingerprints[file_dict_path_str] != fingerprint:
+                    on_conflict(file_dict_path_str)
+                continue
+            fingerprints[file_dict_path_str] = fingerprint
+        yield file_dict_path_str, value
+
+
+def merge_packs(paths, sort_key, jobs, allow_mismatch, write):
+    """Merge pack files and pass the result to write(entries).
+
+    entries is an iterable of (file_dict_path_str, value) without
+    duplicates, sorted by sort_key unless it is None.  Inputs are assumed to
+    be sorted the same way and are merged as they are read.  If they are
+    not, write() is called again with entries merged in memory, and must
+    start over.
+
+    Conflicts and stale strings are reported once write() returned.  Return
+    False if the merge must be aborted because of conflicts."""
+    # reported once the output is written, in case it is written twice.
+    conflicts = []
+    stale = []
+
+    def find_stale(entries):
+        for file_dict_path_str, value in entries:
+            if file_dict_path_str not in sort_key.string_order:
+                stale.append(file_dict_path_str)
+            yield file_dict_path_str, value
+
+    def write_merged(entries):
+        conflicts.clear()
+        stale.clear()
+        entries = drop_duplicates(entries, conflicts.append,
+                                  sort_key is not None)
+        if isinstance(sort_key, GameOrder):
+            entries = find_stale(entries)
+        if sort_key is not None:
+            entries = ((file_dict_path_str, common.sort_pack_entry(value))
+                       for file_dict_path_str, value in entries)
+        write(entries)
+
+    if sort_key is None:
+        write_merged(iterate_packs(paths, jobs))
+    else:
+        try:
+            write_merged(merge_sorted_packs(paths, sort_key, jobs))
+        except UnsortedPackError as exc:
+            print("note:", str(exc) + ", merging in memory instead")
+            write_merged(merge_packs_in_memory(paths, sort_key, jobs))
+
+    if isinstance(sort_key, GameOrder):
+        sort_key.log_stale(stale)
+    for file_dict_path_str in conflicts:
+        print("Multiple different value found for", file_dict_path_str)
+    if conflicts:
+        if not allow_mismatch:
+            print("Aborting...")
+            return False
+        print("Continuing anyway...")
+    return True
 
 
 def do_merge(args):
-    """Merge multiple pack files into one big pack file."""
-    sorter = get_sorter(args)
+    """Merge multiple pack files into one big pack file.
 
-    big_result = {}
-    error = False
-    for usable_path, _ in common.walk_files(args.inputpath):
-        for file_dict_path_str, value in common.load_json(usable_path).items():
-            if big_result.setdefault(file_dict_path_str, value) != value:
-                print("Multiple different value found for", file_dict_path_str)
-                error = True
-    if error:
-        if args.allow_mismatch:
-            print("Continuing anyway...")
+    If the output is sorted, then input packs are assumed to be sorted in
+    the same order and merged as they are read.  If they are not, then fall
+    back to merging everything in memory."""
+    paths = [usable_path
+             for usable_path, _ in common.walk_files(args.inputpath)]
+
+    def write(entries):
+        common.save_json_items(args.bigpack + ".new", entries)
+
+    if not merge_packs(paths, get_sort_key(args), args.jobs,
+                       args.allow_mismatch, write):
+        os.remove(args.bigpack + ".new")
+        sys.exit(1)
+    os.replace(args.bigpack + ".new", args.bigpack)
+
+
+def diff_langfiles(file_path, from_json, translations):
+    """Calculate packs from a lang file and its translations.
+
+    translations is a dict from locale to the content of a translated lang
+    file.  Return a dict from locale to the pack of that locale, in game
+    order.  Every file is walked at the same time, instead of looking up
+    every string of the original in every translation."""
+    # None cannot collide with a locale
+    json_dict = {None: from_json}
+    json_dict.update(translations)
+    results = {locale: {} for locale in translations}
+    iterator = common.walk_langfile_json(json_dict, [], [])
+    for langlabel, dict_path, _ in iterator:
+        orig = langlabel.get(None)
+        if orig is None or len(langlabel) == 1:
+            continue
+        file_dict_path_str = common.serialize_dict_path(file_path, dict_path)
+        for locale, text in langlabel.items():
+            if locale is not None:
+                results[locale][file_dict_path_str] = {"orig": orig,
+                                                       "text": text}
+    return results
+
+
+def find_langfile_translations(orig_dir, trans_dir, from_locale, locales):
+    """Pair lang files with their translations.
+
+    Yield (path, relative path, {locale: path of the translated file}) for
+    every <name>.<from_locale>.json in orig_dir, where translated files are
+    the existing <name>.<locale>.json in the same relative directory of
+    trans_dir.  If locales is None, use every locale found there."""
+    suffix = ".%s.json" % from_locale
+    for usable_path, rel_path in common.walk_files(orig_dir):
+        if not rel_path.endswith(suffix):
+            continue
+        stem = os.path.join(trans_dir, rel_path[:-len(suffix)])
+        if locales is None:
+            prefix = os.path.basename(stem) + "."
+            try:
+                names = os.listdir(os.path.dirname(stem))
+            except OSError:
+                names = []
+            candidates = sorted(name[len(prefix):-5] for name in names
+                                if name.startswith(prefix)
+                                and name.endswith(".json"))
+            candidates = [locale for locale in candidates
+                          if locale and "." not in locale
+                          and locale != from_locale]
         else:
-            print("Aborting...")
-            sys.exit(1)
-    big_result = sorter(big_result)
+            candidates = locales
+        translations = {}
+        for locale in candidates:
+            path = "%s.%s.json" % (stem, locale)
+            if os.path.isfile(path):
+                translations[locale] = path
+            else:
+                print("note: no translation to", locale, "for", rel_path)
+        yield usable_path, rel_path, translations
+
+
+def diff_langfile_job(job):
+    """Load and diff a lang file with its translations, for do_diff_langdir"""
+    file_path, orig_path, translated_paths = job
+    translations = {locale: common.load_json(path)
+                    for locale, path in translated_paths.items()}
+    return diff_langfiles(file_path, common.load_json(orig_path),
+                          translations)
+
+
+def do_diff_langdir(args):
+    """Calculate one pack per locale given directories of lang files."""
+    if args.resultfile == '-':
+        print("lang file directories give one pack per locale, which cannot",
+              "be written to the standard output")
+        sys.exit(1)
+    if os.path.exists(args.resultfile) and not os.path.isdir(args.resultfile):
+        print("lang file directories give one pack per locale, so",
+              args.resultfile, "must be a directory")
+        sys.exit(1)
+    if args.filename is not None:
+        prefix = args.filename.split('/')
+    else:
+        prefix = ["lang", "sc"]
+    jobs = []
+    for orig_path, rel_path, translations in find_langfile_translations(
+            args.fileorig, args.filetrans, args.from_locale,
+            args.to_locales):
+        file_path = prefix + rel_path.split(os.sep)
+        jobs.append((file_path, orig_path, translations))
+
+    results = {locale: {} for locale in args.to_locales or ()}
+    if args.jobs > 1:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+            for packs in executor.map(diff_langfile_job, jobs):
+                for locale, pack in packs.items():
+                    results.setdefault(locale, {}).update(pack)
+    else:
+        for packs in map(diff_langfile_job, jobs):
+            for locale, pack in packs.items():
+                results.setdefault(locale, {}).update(pack)
 
-    common.save_json(args.bigpack, big_result)
+    os.makedirs(args.resultfile, exist_ok=True)
+    for locale, result in results.items():
+        # we are already sorted by game order
+        if args.sort_order == "alpha":
+            result = common.sort_dict(result)
+        print("%s: %d strings" % (locale, len(result)))
+        common.save_json(os.path.join(args.resultfile, "%s.json" % locale),
+                         result)
 
 
 def do_diff_langfile(args):
     """Calculate a pack file given two lang files."""
+    if os.path.isdir(args.fileorig):
+        do_diff_langdir(args)
+        return
     from_json = common.load_json(args.fileorig)
     to_json = common.load_json(args.filetrans)
     if "filename" in args and args.filename is not None:
         file_path = args.filename.split('/')
     else:
         file_path = ["lang", "sc", os.path.basename(args.fileorig)]
-    result = {}
-    # This is arbitrary. "foobar" or "en_US" would also work.
-    from_locale = args.from_locale
-    iterator = common.walk_langfile_json({from_locale: from_json}, [], [])
-    for langlabel, dict_path, _ in iterator:
-        text = common.get_data_by_dict_path(to_json, dict_path)
-        if text is None:
-            continue
-        trans = {"orig": langlabel[from_locale], "text": text}
-
-        result[common.serialize_dict_path(file_path, dict_path)] = trans
+    result = diff_langfiles(file_path, from_json, {"": to_json})[""]
     # we are already sorted by game order
     if args.sort_order == "alpha":
         result = common.sort_dict(result)
@@ -265,6 +626,91 @@ class SparsePriorityQueue:
             yield from self.prio_to_value[key]
 
 
+def bounded_edit_distance(text_a, text_b, max_distance):
+    """Return the Levenshtein distance between two strings, if small enough.
+
+    If the distance is greater than max_distance, return None.  This only
+    computes a band of width 2*max_distance+1 of the usual matrix, so it
+    runs in O(len * max_distance)."""
+    if len(text_a) > len(text_b):
+        text_a, text_b = text_b, text_a
+    if len(text_b) - len(text_a) > max_distance:
+        return None
+    too_much = max_distance + 1
+    previous = list(range(len(text_b) + 1))
+    for i, char_a in enumerate(text_a, 1):
+        low = max(1, i - max_distance)
+        high = min(len(text_b), i + max_distance)
+        current = [too_much] * (len(text_b) + 1)
+        current[0] = i if i <= max_distance else too_much
+        best = current[0]
+        for j in range(low, high + 1):
+            cost = previous[j - 1] + (char_a != text_b[j - 1])
+            cost = min(cost, previous[j] + 1, current[j - 1] + 1)
+            current[j] = cost if cost < too_much else too_much
+            if cost < best:
+                best = cost
+        if best > max_distance:
+            return None
+        previous = current
+    distance = previous[len(text_b)]
+    return distance if distance <= max_distance else None
+
+
+class FuzzyTextIndex:
+    """Find near-duplicate texts using locality-sensitive hashing.
+
+    Texts are cut into character n-grams and summarized with a MinHash
+    signature, which is split in bands.  Two texts sharing any band are
+    candidates, which means that texts with a high n-gram similarity are
+    very likely to be proposed, without comparing everything to
+    everything."""
+    NGRAM_SIZE = 3
+    BANDS = 8
+    ROWS_PER_BAND = 3
+    # Buckets larger than this are ignored, they usually contain very common
+    # texts which are not interesting to match fuzzily.
+    MAX_BUCKET_SIZE = 64
+
+    def __init__(self):
+        # fixed seed, for reproducible migration plans.
+        rng = random.Random(42)
+        self.masks = [rng.getrandbits(64)
+                      for i in range(self.BANDS * self.ROWS_PER_BAND)]
+        # (band index, band) => [values]
+        self.buckets = {}
+
+    def signature(self, text):
+        """Return the MinHash signature of text, as a tuple of integers"""
+        text = text.lower()
+        size = self.NGRAM_SIZE
+        # not hash(), which is salted differently in each process.
+        hashes = frozenset(zlib.crc32(text[i:i+size].encode())
+                           for i in range(max(1, len(text) - size + 1)))
+        return tuple(min(map(mask.__xor__, hashes)) for mask in self.masks)
+
+    def iterate_bands(self, text):
+        """Yield the bucket keys of text"""
+        signature = self.signature(text)
+        rows = self.ROWS_PER_BAND
+        for band in range(self.BANDS):
+            yield band, signature[band * rows:(band + 1) * rows]
+
+    def add(self, text, value):
+        """Index a text, which will be returned as value by candidates()"""
+        for key in self.iterate_bands(text):
+            self.buckets.setdefault(key, []).append(value)
+
+    def candidates(self, text):
+        """Return the set of values whose text may be similar to text"""
+        ret = set()
+        for key in self.iterate_bands(text):
+            bucket = self.buckets.get(key, ())
+            if len(bucket) <= self.MAX_BUCKET_SIZE:
+                ret.update(bucket)
+        return ret
+
+
 class MigrationCalculator:
     """Matches a source string cache to a destination string and migrate packs
 
@@ -274,6 +720,10 @@ class MigrationCalculator:
         self.dest = destination_string_cache
         # Maps old file_dict_path to new file_dict_path (or None if unchanged)
         self.map = {}
+        # Maps file_dict_path to normalized entries, see normalize_entry().
+        # These are never drained, only self.src and self.dest are.
+        self.src_entries = self.normalize_cache(self.src)
+        self.dest_entries = self.normalize_cache(self.dest)
 
     # the code below assumes same file matches trump all other matches
     SAME_FILE = 1000
@@ -285,16 +735,13 @@ class MigrationCalculator:
     SAME_FILE_MAX_SCORE = 5000
 
     @classmethod
-    def base_match_score(cls, src_file_dict_path, dest_file_dict_path):
+    def base_match_score(cls, src_entry, dest_entry):
         """Calculate the base match score from file dict paths alone."""
-        if src_file_dict_path == dest_file_dict_path:
-            return cls.SAME_FILE + cls.SAME_DICT_PATH
-
-        src = common.split_file_dict_path(src_file_dict_path)
-        src_file, src_path = src
-        dest = common.split_file_dict_path(dest_file_dict_path)
-        dest_file, dest_path = dest
+        src_file, src_path, _, _ = src_entry
+        dest_file, dest_path, _, _ = dest_entry
         if src_file == dest_file:
+            if src_path == dest_path:
+                return cls.SAME_FILE + cls.SAME_DICT_PATH
             return cls.SAME_FILE
         if src_path == dest_path:
             return cls.SAME_DICT_PATH
@@ -314,25 +761,60 @@ class MigrationCalculator:
         return string
 
     @classmethod
-    def match_score(cls, src_file_dict_path, dest_file_dict_path,
-                    src_langlabel, dest_langlabel):
+    def normalize_entry(cls, file_dict_path_str, langlabel):
+        """Precompute everything match_score() needs about a lang label.
+
+        Return a (file_str, dict_path_str, fields, fields_hash) tuple, where
+        'fields' is a dict from lang label keys to their interned values with
+        annotations stripped.  Fields that can never be used for matching
+        (empty values or values equal to their key) are not included.
+        'fields_hash' is a hash of 'fields', equal hashes are a strong hint
+        that two lang labels are identical."""
+        file_str, dict_path_str = common.split_file_dict_path(
+            file_dict_path_str)
+        fields = {}
+        for key, value in langlabel.items():
+            value = cls.strip_annotations(value)
+            if not value or value == key:
+                continue
+            if isinstance(value, str):
+                value = sys.intern(value)
+            fields[sys.intern(key)] = value
+        try:
+            fields_hash = hash(frozenset(fields.items()))
+        except TypeError:
+            # unhashable values in a lang label ? never match it fast.
+            fields_hash = None
+        return (sys.intern(file_str), dict_path_str, fields, fields_hash)
+
+    @classmethod
+    def normalize_cache(cls, string_cache):
+        """Normalize every entry of a string cache.
+
+        Return a dict from file_dict_path to normalize_entry() results"""
+        normalized = {}
+        for langlabel, _, file_dict_path_str, _ in string_cache.iterate():
+            normalized[file_dict_path_str] = cls.normalize_entry(
+                file_dict_path_str, langlabel)
+        return normalized
+
+    @classmethod
+    def match_score(cls, src_entry, dest_entry):
         """Return a score indicating how the old and new lang label matches.
 
+        Both parameters are normalized entries (see normalize_entry()).
         The higher the score, the closer the two lang labels are related.
 
         If it returns 0, then matching should be forbidden."""
 
-        base_score = cls.base_match_score(src_file_dict_path,
-                                          dest_file_dict_path)
+        base_score = cls.base_match_score(src_entry, dest_entry)
+        dest_fields = dest_entry[2]
 
         field_perfect = True
         field_score = 0
         same_languid = False
-        for key, value in src_langlabel.items():
-            value = cls.strip_annotations(value)
-            if not value or value == key:
-                continue
-            if cls.strip_annotations(dest_langlabel.get(key)) == value:
+        for key, value in src_entry[2].items():
+            if dest_fields.get(key) == value:
                 field_score += cls.SAME_FIELD
                 if key == "langUid":
                     same_languid = True
@@ -367,12 +849,16 @@ class MigrationCalculator:
         Return number of drained elements"""
         perfect_matches = []
         # still can't drain while iterating ?
-        for src_langlabel, _, src_file_dict_path, _ in self.src.iterate():
-            dest_ll = self.dest.get_complete_by_str(src_file_dict_path)[0]
-            if dest_ll is None:
+        for _, _, src_file_dict_path, _ in self.src.iterate():
+            dest_entry = self.dest_entries.get(src_file_dict_path)
+            if dest_entry is None or not self.dest.has(src_file_dict_path):
                 continue
-            if self.match_score(src_file_dict_path, src_file_dict_path,
-                                src_langlabel, dest_ll) == self.MAX_SCORE:
+            src_entry = self.src_entries[src_file_dict_path]
+            # fast path: same fields means a perfect match.
+            if (src_entry[3] is not None and src_entry[3] == dest_entry[3]
+                    and src_entry[2] == dest_entry[2]):
+                perfect_matches.append(src_file_dict_path)
+            elif self.match_score(src_entry, dest_entry) == self.MAX_SCORE:
                 perfect_matches.append(src_file_dict_path)
 
         for match in perfect_matches:
@@ -384,7 +870,8 @@ class MigrationCalculator:
         """Attempt to find an assignment from src_map to dest_map
 
         src_map must be a subset of self.src and dest_map must be a subset
-        of self.dest.  prio_queue must be a SparsePriorityQueue.
+        of self.dest, both mapping file_dict_path to normalized entries.
+        prio_queue must be a SparsePriorityQueue.
         If perfect_score is set and reached, then assume this is the best
         possible outcome and assign it on the spot, to stop trying to search
         for anything better.
@@ -398,12 +885,10 @@ class MigrationCalculator:
         if perfect_score is None:
             perfect_score = 2**30
         perfect_matches = 0
-        for src_file_dict_path, src_langlabel in src_map.items():
+        for src_file_dict_path, src_entry in src_map.items():
             potential_mappings = []
-            for dest_file_dict_path, dest_langlabel in dest_map.items():
-                score = self.match_score(src_file_dict_path,
-                                         dest_file_dict_path,
-                                         src_langlabel, dest_langlabel)
+            for dest_file_dict_path, dest_entry in dest_map.items():
+                score = self.match_score(src_entry, dest_entry)
                 if score >= perfect_score:
                     self.assign(src_file_dict_path, dest_file_dict_path, True)
                     perfect_matches += 1
@@ -431,16 +916,17 @@ class MigrationCalculator:
             self.assign(src_file_dict_path, dest_file_dict_path, False)
 
     @staticmethod
-    def sort_by_file(string_cache):
-        """Return a dict from file_path to a dict from dict_path to lang labels
+    def sort_by_file(string_cache, entries):
+        """Return a dict from file_path to a dict from dict_path to entries
 
-        i.e. a file_path => (dict_path => lang_label)."""
+        i.e. a file_path => (dict_path => normalized entry), for every entry
+        still present in string_cache."""
 
         by_file = {}
-        for langlabel, _, file_dict_path_str, _ in string_cache.iterate():
-            file_str = common.split_file_dict_path(file_dict_path_str)[0]
-            map_for_file = by_file.setdefault(file_str, {})
-            map_for_file[file_dict_path_str] = langlabel
+        for _, _, file_dict_path_str, _ in string_cache.iterate():
+            entry = entries[file_dict_path_str]
+            map_for_file = by_file.setdefault(entry[0], {})
+            map_for_file[file_dict_path_str] = entry
         return by_file
 
     def do_same_file_map(self):
@@ -449,8 +935,8 @@ class MigrationCalculator:
         Return number of drained elements, number of perfect matches"""
 
         orig_size = self.src.size()
-        src_by_file = self.sort_by_file(self.src)
-        dest_by_file = self.sort_by_file(self.dest)
+        src_by_file = self.sort_by_file(self.src, self.src_entries)
+        dest_by_file = self.sort_by_file(self.dest, self.dest_entries)
         perfect_matches = 0
 
         for src_file_str, src_per_file_map in src_by_file.items():
@@ -469,43 +955,197 @@ class MigrationCalculator:
 
         return orig_size - self.src.size(), perfect_matches
 
+    # Minimum ratio of shared lang labels between a vanished file and a new
+    # file to consider that the file was renamed or moved.
+    FILE_MOVE_MIN_OVERLAP = 0.5
+
+    def file_fingerprints(self, string_cache, entries, file_strs):
+        """Return a dict from file_str to the set of hashes of its lang labels
+
+        Only files in file_strs and entries still in string_cache are
+        considered."""
+        fingerprints = {}
+        for _, _, file_dict_path_str, _ in string_cache.iterate():
+            file_str, _, _, fields_hash = entries[file_dict_path_str]
+            if file_str not in file_strs or fields_hash is None:
+                continue
+            fingerprints.setdefault(file_str, set()).add(fields_hash)
+        return fingerprints
+
+    def find_moved_files(self):
+        """Pair source files that vanished with destination files that appeared
+
+        Return a list of (src_file_str, dest_file_str), each file appearing
+        at most once, paired by decreasing overlap of their lang labels."""
+        src_files = frozenset(entry[0] for entry in self.src_entries.values())
+        dest_files = frozenset(entry[0]
+                               for entry in self.dest_entries.values())
+
+        vanished = self.file_fingerprints(self.src, self.src_entries,
+                                          src_files - dest_files)
+        appeared = self.file_fingerprints(self.dest, self.dest_entries,
+                                          dest_files - src_files)
+        if not vanished or not appeared:
+            return []
+
+        dest_files_by_hash = {}
+        for dest_file_str, hashes in appeared.items():
+            for fields_hash in hashes:
+                dest_files_by_hash.setdefault(fields_hash, []).append(
+                    dest_file_str)
+
+        candidates = []
+        for src_file_str, hashes in vanished.items():
+            shared = {}
+            for fields_hash in hashes:
+                for dest_file_str in dest_files_by_hash.get(fields_hash, ()):
+                    shared[dest_file_str] = shared.get(dest_file_str, 0) + 1
+            for dest_file_str, count in shared.items():
+                union = len(hashes) + len(appeared[dest_file_str]) - count
+                overlap = count / union
+                if overlap >= self.FILE_MOVE_MIN_OVERLAP:
+                    candidates.append((-overlap, src_file_str, dest_file_str))
+
+        candidates.sort()
+        paired_src = set()
+        paired_dest = set()
+        pairs = []
+        for _, src_file_str, dest_file_str in candidates:
+            if src_file_str in paired_src or dest_file_str in paired_dest:
+                continue
+            paired_src.add(src_file_str)
+            paired_dest.add(dest_file_str)
+            pairs.append((src_file_str, dest_file_str))
+        return pairs
+
+    def do_file_move_map(self):
+        """Assign lang labels of files that were renamed or moved as a whole
+
+        Files are paired with find_moved_files(), then matched as if they
+        were the same file.
+        Return number of drained elements, number of moved files"""
+        orig_size = self.src.size()
+        pairs = self.find_moved_files()
+        if not pairs:
+            return 0, 0
+        src_by_file = self.sort_by_file(self.src, self.src_entries)
+        dest_by_file = self.sort_by_file(self.dest, self.dest_entries)
+
+        for src_file_str, dest_file_str in pairs:
+            # pretend the source lang labels were in the new file.
+            src_per_file_map = {}
+            for file_dict_path_str, entry in src_by_file[src_file_str].items():
+                src_per_file_map[file_dict_path_str] = (dest_file_str,
+                                                        *entry[1:])
+            dest_per_file_map = dest_by_file[dest_file_str]
+
+            prio_queue = SparsePriorityQueue()
+            self.assignment_algorithm(src_per_file_map, dest_per_file_map,
+                                      prio_queue, self.SAME_FILE_MAX_SCORE)
+            self.assign_by_prio_queue(prio_queue)
+
+        return orig_size - self.src.size(), len(pairs)
+
     def do_remaining(self):
         """Perform an assignment from everything to everything
 
         This is slow, use it after everything else.
         Return number of drained elements
         """
-        def all_of_them(string_cache):
+        def all_of_them(string_cache, entries):
             ret = {}
-            for langlabel, _, file_dict_path_str, _ in string_cache.iterate():
-                ret[file_dict_path_str] = langlabel
+            for _, _, file_dict_path_str, _ in string_cache.iterate():
+                ret[file_dict_path_str] = entries[file_dict_path_str]
             return ret
         big_prio_queue = SparsePriorityQueue()
-        src_map = all_of_them(self.src)
-        dest_map = all_of_them(self.dest)
+        src_map = all_of_them(self.src, self.src_entries)
+        dest_map = all_of_them(self.dest, self.dest_entries)
         self.assignment_algorithm(src_map, dest_map, big_prio_queue)
         self.assign_by_prio_queue(big_prio_queue)
         return len(src_map) - self.src.size()
 
-    def do_everything(self, no_interfile_move=False):
+    # Minimum similarity (1 - edit distance / length) for fuzzy matches
+    FUZZY_MIN_SIMILARITY = 0.8
+    # Texts shorter than that are not matched fuzzily.
+    FUZZY_MIN_LENGTH = 10
+
+    def do_fuzzy_map(self, locale, no_interfile_move=False):
+        """Match remaining lang labels whose text in locale changed slightly
+
+        Candidates are found with a FuzzyTextIndex over the remaining
+        destination texts, then verified with a bounded edit distance.
+        If no_interfile_move is true, only match within the same file.
+
+        Return number of drained elements"""
+        def get_text(entry):
+            text = entry[2].get(locale)
+            if isinstance(text, str) and len(text) >= self.FUZZY_MIN_LENGTH:
+                return text
+            return None
+
+        index = FuzzyTextIndex()
+        for _, _, file_dict_path_str, _ in self.dest.iterate():
+            text = get_text(self.dest_entries[file_dict_path_str])
+            if text is not None:
+                index.add(text, file_dict_path_str)
+
+        orig_size = self.src.size()
+        prio_queue = SparsePriorityQueue()
+        for _, _, src_file_dict_path, _ in self.src.iterate():
+            src_entry = self.src_entries[src_file_dict_path]
+            src_text = get_text(src_entry)
+            if src_text is None:
+                continue
+            for dest_file_dict_path in index.candidates(src_text):
+                dest_entry = self.dest_entries[dest_file_dict_path]
+                base_score = self.base_match_score(src_entry, dest_entry)
+                if no_interfile_move and base_score < self.SAME_FILE:
+                    continue
+                dest_text = dest_entry[2][locale]
+                length = max(len(src_text), len(dest_text))
+                max_distance = int(length * (1 - self.FUZZY_MIN_SIMILARITY))
+                distance = bounded_edit_distance(src_text, dest_text,
+                                                 max_distance)
+                if distance is None:
+                    continue
+                similarity = 1 - distance / length
+                score = base_score + int(self.SAME_FIELD * similarity)
+                prio_queue.insert(-score, (src_file_dict_path,
+                                           dest_file_dict_path))
+        self.assign_by_prio_queue(prio_queue)
+        return orig_size - self.src.size()
+
+    def do_everything(self, no_interfile_move=False, fuzzy_locale=None):
         """Run the entire algorithm, which will:
         - Assign greddily lang labels that didn't change.
         - Try to detect lang labels that moved or were changed within a file.
+        - Try to detect whole files that were renamed or moved, and match
+          their lang labels as if they were in the same file.
         - Try to detect lang labels that moved or were changed across files
           (unless no_interfile_move is false).
+        - If fuzzy_locale is set, try to match the remaining lang labels
+          whose text in this locale is similar.
 
         Will print statistics on standard output when finished."""
         perfect = self.do_greddy_map()
         same_file, perfect_same_file = self.do_same_file_map()
-        remaining = 0
+        moved_file = moved_files = remaining = 0
         if not no_interfile_move:
+            moved_file, moved_files = self.do_file_move_map()
             remaining = self.do_remaining()
+        fuzzy = 0
+        if fuzzy_locale is not None:
+            fuzzy = self.do_fuzzy_map(fuzzy_locale, no_interfile_move)
 
         print("Migration statistics:")
         print("Unchanged                   : %7d" % perfect)
         print("Moved as-is in same file    : %7d" % perfect_same_file)
         print("Found modified in same file : %7d" % same_file)
+        print("Found in moved files        : %7d (%d files)" % (moved_file,
+                                                             moved_files))
         print("Matched in another file     : %7d" % remaining)
+        if fuzzy_locale is not None:
+            print("Matched with similar text   : %7d" % fuzzy)
         print("")
         print("Unmigrated lang labels (to delete) : %7d" % self.src.size())
         print("New lang labels                    : %7d" % self.dest.size())
@@ -535,13 +1175,25 @@ def do_calcmigrate(args):
     """Calculate a migration plan from two string caches."""
     source = common.string_cache()
     dest = common.string_cache()
-    source.load_from_file(args.source_string_cache)
-    dest.load_from_file(args.dest_string_cache)
+    # both versions share most of their texts
+    interner = common.StringInterner()
+    source.load_from_file(args.source_string_cache, interner=interner)
+    dest.load_from_file(args.dest_string_cache, interner=interner)
+    print("Loaded string caches,", interner.report())
     migrator = MigrationCalculator(source, dest)
-    migrator.do_everything(bool(args.no_file_move))
+    fuzzy_locale = args.from_locale if args.fuzzy else None
+    migrator.do_everything(bool(args.no_file_move), fuzzy_locale)
     migrator.write_json(args.migration_plan)
 
 
+def load_migration_plan(path):
+    """Load a migration plan written by calcmigration"""
+    plan = common.load_json(path)
+    return types.SimpleNamespace(to_delete=set(plan["delete"]),
+                                 unchanged=set(plan["unchanged"]),
+                                 migrate=plan["migrate"])
+
+
 def migrate_pack(args, plan, sparse_reader, packfile):
     """Migrate a single pack according to a migration plan."""
     result = {}
@@ -575,10 +1227,7 @@ def do_migrate(args):
     """Migrate one or more pack file according to a migration file."""
     sorter = get_sorter(args)
     sparse_reader = get_sparse_reader(args)
-    plan = common.load_json(args.migration_plan)
-    plan = types.SimpleNamespace(to_delete=set(plan["delete"]),
-                                 unchanged=set(plan["unchanged"]),
-                                 migrate=plan["migrate"])
+    plan = load_migration_plan(args.migration_plan)
     iterator = common.transform_file_or_dir(args.inputpath, args.outputpath)
     for input_file, output_file, _ in iterator:
         try:
@@ -595,24 +1244,195 @@ def do_migrate(args):
         common.save_json(output_file, sorter(dst_pack))
 
 
-def do_filter(args):
-    """Filter a pack and write the result to another one"""
-    sorter = get_sorter(args)
-    walker = get_walker(args)
+def filter_pack(args, walker, pack):
+    """Return the entries of a pack that pass the filters of args
 
+    The filters of the walker are reset afterward, so it may be reused."""
     walker.set_file_path_filter(args.filter_file_path)
     walker.set_dict_path_filter(args.filter_dict_path)
     walker.set_tags_filter(args.filter_tags)
     walker.set_orig_filter(args.filter_orig)
+    try:
+        return dict(walker.walk_pack(pack))
+    finally:
+        walker.set_file_path_filter(None)
+        walker.set_dict_path_filter(None)
+        walker.set_tags_filter(None)
+        walker.set_orig_filter(None)
+
+
+def do_filter(args):
+    """Filter a pack and write the result to another one"""
+    sorter = get_sorter(args)
+    walker = get_walker(args)
 
     pack = common.load_json(args.inputpack)
-    new_pack = dict(walker.walk_pack(pack))
+    new_pack = filter_pack(args, walker, pack)
     new_pack = sorter(new_pack)
     common.save_json(args.outputpack, new_pack)
 
 
-def parse_args():
-    """Parse the command line parameters"""
+class PipelineResources:
+    """Objects shared by all stages of a pipeline, created when first needed
+
+    This avoids loading the string cache or walking the game multiple
+    times."""
+    def __init__(self, args):
+        self.args = args
+        self.walker = None
+        self.sparse_reader = None
+        self.sort_key = None
+        self.sort_key_created = False
+
+    def get_walker(self):
+        if self.walker is None:
+            self.walker = get_walker(self.args)
+        return self.walker
+
+    def get_sparse_reader(self):
+        if self.sparse_reader is None:
+            walker = self.get_walker()
+            if walker.string_cache is not None:
+                self.sparse_reader = walker.string_cache
+            else:
+                self.sparse_reader = common.sparse_dict_path_reader(
+                    self.args.gamedir, self.args.from_locale)
+        return self.sparse_reader
+
+    def get_sort_key(self):
+        if not self.sort_key_created:
+            if self.args.sort_order == "game":
+                self.sort_key = GameOrder(self.get_walker(),
+                                          self.args.from_locale)
+            else:
+                self.sort_key = get_sort_key(self.args)
+            self.sort_key_created = True
+        return self.sort_key
+
+
+def merge_stage(args, resources, pack):
+    """Pipeline version of merge, the input pack is ignored"""
+    paths = [usable_path
+             for usable_path, _ in common.walk_files(args.inputpath)]
+    result = {}
+
+    def write(entries):
+        result.clear()
+        result.update(entries)
+
+    if not merge_packs(paths, resources.get_sort_key(), args.jobs,
+                       args.allow_mismatch, write):
+        sys.exit(1)
+    return result
+
+
+def filter_stage(args, resources, pack):
+    """Pipeline version of filter"""
+    return filter_pack(args, resources.get_walker(), pack)
+
+
+def migrate_stage(args, resources, pack):
+    """Pipeline version of migrate"""
+    plan = load_migration_plan(args.migration_plan)
+    return migrate_pack(args, plan, resources.get_sparse_reader(), pack)
+
+
+def split_stage(args, resources, pack):
+    """Pipeline version of split, which has no output pack"""
+    map_file = common.load_json(args.mapfile)
+    to_write = bucket_split_pack(pack.items(), map_file, args.strip,
+                                 args.outputpath)
+    write_split_packs(to_write, resources.get_sort_key(), args.jobs)
+
+
+# command => (option naming the input pack, option naming the output pack,
+#             function taking (args, resources, pack) and returning a pack)
+PIPELINE_STAGES = {
+    "merge": (None, "bigpack", merge_stage),
+    "filter": ("inputpack", "outputpack", filter_stage),
+    "migrate": ("inputpath", "outputpath", migrate_stage),
+    "split": ("bigpack", None, split_stage),
+}
+
+
+def get_pipeline_stages(args):
+    """Return the command line of every stage, from --spec or from the
+    command line, where stages are separated by '+'"""
+    if args.spec is not None:
+        import shlex
+        return [shlex.split(stage) if isinstance(stage, str) else stage
+                for stage in common.load_json(args.spec)]
+    stages = [[]]
+    for arg in args.stages:
+        if arg == "+":
+            stages.append([])
+        else:
+            stages[-1].append(arg)
+    return [stage for stage in stages if stage]
+
+
+def parse_pipeline_stages(args):
+    """Parse and check every stage, return a list of (command, args)
+
+    Every stage inherits the global options of the pipeline.  Nothing is
+    read or written, so a bad pipeline is rejected before doing anything."""
+    import argparse
+    parser = make_parser()
+    stages = []
+    has_pack = False
+    for stage_argv in get_pipeline_stages(args):
+        command = stage_argv[0]
+        if command not in PIPELINE_STAGES:
+            print("invalid pipeline stage", repr(command), "(allowed: %s)"
+                  % ", ".join(PIPELINE_STAGES))
+            sys.exit(1)
+        stage_args = parser.parse_args(stage_argv,
+                                       namespace=argparse.Namespace(
+                                           **vars(args)))
+        input_option, output_option, _ = PIPELINE_STAGES[command]
+        if input_option is not None:
+            input_path = getattr(stage_args, input_option)
+            if input_path == "-" and not has_pack:
+                print("stage", command, "reads '-' but the previous stage",
+                      "does not output a pack")
+                sys.exit(1)
+            if input_path != "-" and os.path.isdir(input_path):
+                print("stage", command, "can only read pack files, not",
+                      "directories like", input_path)
+                sys.exit(1)
+        has_pack = output_option is not None
+        stages.append((command, stage_args))
+    if not stages:
+        print("No pipeline stages given")
+        sys.exit(1)
+    if has_pack and getattr(stage_args, output_option) == "-":
+        print("note: the output of the last stage is not written anywhere")
+    return stages
+
+
+def do_pipeline(args):
+    """Run several commands, passing packs in memory between them."""
+    stages = parse_pipeline_stages(args)
+    resources = PipelineResources(args)
+    pack = None
+    for command, stage_args in stages:
+        input_option, output_option, function = PIPELINE_STAGES[command]
+        if input_option is not None:
+            input_path = getattr(stage_args, input_option)
+            if input_path != "-":
+                pack = common.load_json(input_path)
+        pack = function(stage_args, resources, pack)
+        if output_option is not None:
+            output_path = getattr(stage_args, output_option)
+            if output_path != "-":
+                # merge_stage() already logged stale strings
+                common.save_json(output_path,
+                                 sort_pack(pack, resources.get_sort_key(),
+                                           command != "merge"))
+
+
+def make_parser():
+    """Create the command line parser"""
     import argparse
     parser = argparse.ArgumentParser(description="Command to manage pack"
                                                  " files\n")
@@ -698,12 +1518,18 @@ def parse_args():
              help="""strip this amount of directories before writing to the
              output. e.g. if the map file references mods/mymod/packs/a, then
              --strip=2 will write it as packs/a in the output directory.""")
+     .option("--jobs", "-j", type=int, default=1, metavar="<processes>",
+             help="""Sort and write the smaller packs using this many
+             processes.""")
      )
 
     (add_subcommand(
         'merge', do_merge, help="merge several packfiles into a big one",
         description="""Merge all packfiles in a directory into a
-                       bigger one.""")
+                       bigger one.  With --sort-output alpha or game, sorted
+                       inputs are streamed.  Otherwise, or if an input is not
+                       sorted, memory use grows with the size of the
+                       result.""")
      .option('inputpath', metavar="<input dir>",
              help="""Where to search for packfiles""")
      .option('bigpack', help="""Where to write the big packfile""")
@@ -711,6 +1537,10 @@ def parse_args():
              help="""If two input pack files possess different translation for
              the same string, then warn and pick the first encountered one.
              The default is to abort in this case.""")
+     .option("--jobs", "-j", type=int, default=1, metavar="<threads>",
+             help="""Read input packs using this many threads.  Note that
+             this reads entire input packs at once instead of streaming them,
+             which uses more memory.""")
      )
 
     (add_subcommand(
@@ -719,18 +1549,33 @@ def parse_args():
         description="""Given two lang files, calculate the difference as
                        a pack file and write the output.  Lang files are
                        files that typically resides under the lang/
-                       directory.""")
+                       directory.  If given directories, then every
+                       <name>.<from locale>.json file of the original
+                       directory is compared with the <name>.<locale>.json
+                       files of the translated directory, and one pack per
+                       locale is written.""")
      .option("--file-path", dest="filename", metavar="<path of original name",
              help="""Path to use to refer to the difference in the output.
              The default is to use 'lang/sc/<filename>' where filename is
-             the name of <original file>""")
+             the name of <original file>.  With directories, this is the
+             path of the original directory instead, 'lang/sc' by
+             default""")
      .option("fileorig", metavar="<original file>",
-             help="""Original file to use as starting point""")
+             help="""Original file or directory to use as starting point""")
      .option("filetrans", metavar="<translated file>",
-             help="""Translated original file""")
+             help="""Translated original file or directory, which may be the
+             same as the original directory""")
      .option("resultfile", metavar="<output file>",
              help="""Where to write the output.  If '-', then output to the
-             standard output""")
+             standard output.  With directories, this is a directory where
+             <locale>.json packs are written""")
+     .option("--to-locales", nargs="+", dest="to_locales",
+             metavar="<locale>",
+             help="""With directories, only create packs for these locales.
+             The default is to use every locale found""")
+     .option("--jobs", "-j", type=int, default=1, metavar="<processes>",
+             help="""With directories, compare files using this many
+             processes""")
      )
 
     (add_subcommand(
@@ -750,6 +1595,12 @@ def parse_args():
      .option("--no-file-move", dest="no_file_move", action="store_true",
              help="""Do not match old lang labels into lang labels in a
              different (game) file.""")
+     .option("--fuzzy", action="store_true",
+             help="""After every other match, try to match the remaining
+             lang labels whose text in the locale specified by --from-locale
+             is similar, e.g. because a typo was fixed.  Such matches should
+             be reviewed, so combine this with --mark-unknown when
+             migrating.""")
      )
 
     (add_subcommand(
@@ -806,7 +1657,33 @@ def parse_args():
              text.""")
     )
 
-    result = parser.parse_args()
+    (add_subcommand(
+        'pipeline', do_pipeline,
+        help="""run several commands without writing intermediate packs""",
+        description="""Run merge, filter, migrate and split commands one
+        after the other.  Each stage is a command line of one of these
+        commands, where '-' can be used as the input pack of a stage to use
+        the output of the previous stage, which is kept in memory.  Output
+        packs named '-' are not written anywhere.  The string cache or the
+        game files are only loaded once, and packs are only sorted when
+        written.  Global options such as --sort-output apply to every
+        stage.  For example:
+        pipeline merge packs/ - + filter - - --filter-tags foo +
+        migrate plan.json - - + split - output/""")
+     .option("--spec", metavar="<spec file>",
+             help="""Read the stages from this JSON file instead of the
+             command line.  It must contain a list of stages, each of them
+             being a list of arguments or a shell-like command line""")
+     .option("stages", nargs=argparse.REMAINDER, metavar="<stage>",
+             help="""command line of every stage, separated by '+'""")
+    )
+
+    return parser
+
+
+def parse_args():
+    """Parse the command line parameters"""
+    result = make_parser().parse_args()
     result.func(result)
 
 